@@ -77,6 +77,83 @@ void FFA_ext(float* XW0, float* XW, int nRow, int nCol, int nStage)
     }
 }
 
+/*
+  Streaming FFA
+
+  Folds the 1-D arrays x (data) and w (weights) on P0 without forming
+  the padded 2-D wrap. Row r, column j of the wrap is element r*P0 + j
+  of the input, and is zero past the end. The sum of the data and the
+  sum of the weights are folded together in one pass.
+
+  Any number of rows is allowed. A block of m rows is split into a head
+  of h = m/2 rows and a tail of t = m - h rows. Output row i (a total
+  drift of i columns over the block) adds head row kh and tail row kt,
+  with the tail shifted by i - kt, where kh and kt are i*(h-1)/(m-1) and
+  i*(t-1)/(m-1) rounded to the nearest integer. When m is a power of 2
+  this is the same butterfly as FFAGroupShiftAdd.
+
+  The result is written to out and scratch is used for the halves. The
+  two swap roles at each level of the recursion, so only two
+  workspaces are needed. Each holds a data plane and a count plane of
+  m*P0 floats.
+*/
+static void FFAStreamRec(float* x, float* w, int n, int row0, int m, int P0,
+			 float* out, float* scratch, int plane)
+{
+  int h,t,i,j,jB,kh,kt,shift,idx;
+  float *outd,*outc,*hd,*hc,*td,*tc;
+
+  if (m == 1)
+    {
+      for(j=0; j<P0; j++)
+	{
+	  idx = row0*P0 + j;
+	  out[j] = 0;
+	  out[plane + j] = 0;
+	  if ((idx < n) && (w[idx] != 0))
+	    {
+	      out[j] = x[idx] * w[idx];
+	      out[plane + j] = w[idx];
+	    }
+	}
+      return;
+    }
+
+  h = m / 2;
+  t = m - h;
+  FFAStreamRec(x, w, n, row0, h, P0, scratch, out, plane);
+  FFAStreamRec(x, w, n, row0 + h, t, P0, scratch + h*P0, out + h*P0, plane);
+
+  for(i=0; i<m; i++)
+    {
+      kh = (2*i*(h-1) + (m-1)) / (2*(m-1));
+      kt = (2*i*(t-1) + (m-1)) / (2*(m-1));
+      shift = (i - kt) % P0;
+
+      outd = out + i*P0;
+      outc = out + plane + i*P0;
+      hd = scratch + kh*P0;
+      hc = scratch + plane + kh*P0;
+      td = scratch + (h + kt)*P0;
+      tc = scratch + plane + (h + kt)*P0;
+
+      jB = shift;
+      for(j=0; j<P0; j++)
+	{
+	  outd[j] = hd[j] + td[jB];
+	  outc[j] = hc[j] + tc[jB];
+	  jB++;
+	  if (jB==P0) {jB=0;} 
+	}
+    }
+}
+
+void FFA_stream_ext(float* x, float* w, int n, int P0, int nRow, float* ws)
+{
+  int plane = nRow*P0;
+  FFAStreamRec(x, w, n, 0, nRow, P0, ws, ws + 2*plane, plane);
+}
+
 int main(int argc, char *argv[])
 {
 
@@ -3,3 +3,5 @@ void FFAGroupShiftAdd(float* group0, float* group,int nRowGroup,int nColGroup);
 void FFAShiftAdd(float* XW0, float* XW, int stage, int nRow, int nCol);
 
 void FFA_ext(float* XW0, float* XW, int nRow, int nCol, int nStage);
+
+void FFA_stream_ext(float* x, float* w, int n, int P0, int nRow, float* ws);
@@ -67,6 +67,7 @@ cdef extern from "FFA.h":
      void FFA_ext(float* XW0, float* XW, int nRow, int nCol, int nStage)
      void FFAGroupShiftAdd(float* group0, float* group, int nRowGroup, int nColGroup)
      void FFAShiftAdd(float* XW0, float* XW, int stage, int nRow, int nCol)
+     void FFA_stream_ext(float* x, float* w, int n, int P0, int nRow, float* ws)
 
 def cFFA_ext( cnp.ndarray[cnp.float32_t, ndim=2,mode='c'] XW0,
              cnp.ndarray[cnp.float32_t, ndim=2,mode='c'] XW,
@@ -90,6 +91,50 @@ def cFFAShiftAdd(cnp.ndarray[cnp.float32_t, ndim=2,mode='c'] XW0,
     FFAShiftAdd(<cnp.float32_t*> XW0.data,<cnp.float32_t*> XW.data,stage, nRow, nCol)
 
 
+def FFAStream(cnp.ndarray[cnp.float32_t, ndim=1,mode='c'] x,
+              cnp.ndarray[cnp.float32_t, ndim=1,mode='c'] w,
+              int P0,
+              cnp.ndarray[cnp.float32_t, ndim=1,mode='c'] ws=None):
+    """
+    Streaming Fast Folding Algorithm
+
+    Fold x and w on P0, P0 + 1/(M-1), ..., P0 + 1 without forming the
+    wrapped array. M = ceil(N / P0) need not be a power of 2. For M a
+    power of 2 the result matches FFA applied to the XWrap2 of x*w and
+    of w.
+
+    Parameters
+    ----------
+    x  : data (float32). Elements with w = 0 are ignored, so they may
+         be nan
+    w  : weights (float32), e.g. 1 for good data and 0 for masked
+    P0 : base period, units of elements
+    ws : workspace with at least 4 * M * P0 elements. It may be reused
+         across calls. If None, a new one is allocated.
+
+    Returns
+    -------
+    sumF   : sum of x*w folded on each trial period, shape (M, P0)
+    countF : sum of w folded on each trial period, shape (M, P0)
+
+    sumF and countF are views into ws and are overwritten by the next
+    call that shares ws.
+    """
+    cdef int n = x.shape[0]
+    cdef int nRow = (n + P0 - 1) / P0
+    cdef int plane = nRow * P0
+
+    assert w.shape[0]==n,"x and w must be the same size"
+    if ws is None:
+        ws = np.empty(4 * plane, dtype=np.float32)
+    assert ws.shape[0] >= 4 * plane,"workspace too small"
+
+    FFA_stream_ext(<cnp.float32_t*> x.data, <cnp.float32_t*> w.data,
+                   n, P0, nRow, <cnp.float32_t*> ws.data)
+
+    sumF = ws[:plane].reshape(nRow,P0)
+    countF = ws[plane:2*plane].reshape(nRow,P0)
+    return sumF,countF
 
 
 ### Adding extra functions
@@ -161,12 +206,13 @@ def XWrap2(x,P0,fill_value=0,pow2=False):
     nrow = int( np.floor(ncad/P0) +1 )
     nExtend = nrow * P0 - ncad # Pad out remainder of array with 0s.
 
+    # Padding keeps the dtype of x, so float32 input stays float32
     if type(x) is np.ma.core.MaskedArray:
-        pad = ma.empty(nExtend)
+        pad = ma.empty(nExtend, dtype=x.dtype)
         pad.mask = True
         x = ma.hstack( (x ,pad) )
     else:    
-        pad = np.empty(nExtend) 
+        pad = np.empty(nExtend, dtype=x.dtype) 
         pad[:] = fill_value
         x = np.hstack( (x ,pad) )
 
@@ -175,7 +221,7 @@ def XWrap2(x,P0,fill_value=0,pow2=False):
     if pow2:
         k = np.ceil(np.log2(nrow)).astype(int)
         nrow2 = 2**k
-        fill    = ma.empty( (nrow2-nrow,P0) )
+        fill    = ma.empty( (nrow2-nrow,P0), dtype=x.dtype )
         fill[:] = fill_value
         fill.mask=True
         xwrap = ma.vstack([xwrap,fill])
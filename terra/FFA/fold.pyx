@@ -4,11 +4,12 @@
 Cython functions for folding
 """
 import cython
+from cython cimport floating
 cimport numpy as np
 
 import numpy as np
 from numpy import ma
-from libc.math cimport exp, sqrt, pow, log, erf
+from libc.math cimport exp, sqrt, pow, log, erf, floor, fmod, ceil, INFINITY
 
 DTYPE = np.float64
 ctypedef np.float64_t DTYPE_t
@@ -18,9 +19,10 @@ ctypedef np.int64_t IDTYPE_t
 
 
 
-cpdef fold_col(np.ndarray[np.float64_t, ndim=1] data,
+cpdef fold_col(np.ndarray[floating, ndim=1] data,
               np.ndarray[np.int64_t, ndim=1] mask, 
-              np.ndarray[np.int64_t, ndim=1] col):
+              np.ndarray[np.int64_t, ndim=1] col,
+              ccol=None, scol=None, sscol=None):
     """
     Fold Columns
 
@@ -29,9 +31,13 @@ cpdef fold_col(np.ndarray[np.float64_t, ndim=1] data,
 
     Parameters
     ----------
-    data : (float) data array
+    data : (float32 or float64) data array. Column statistics are
+        accumulated in double precision either way.
     mask : (int) mask for data array. 1 = masked out.
     col : (int) column corresponding to phase bin of measurement.
+    ccol, scol, sscol : (optional) work arrays to accumulate into,
+        with at least max(col) + 1 elements. The first max(col) + 1
+        elements are zeroed. If not given, new arrays are allocated.
 
     Return
     ------
@@ -45,9 +51,20 @@ cpdef fold_col(np.ndarray[np.float64_t, ndim=1] data,
     ncol = np.max(col)+1
     
     # Define column arrays
-    cdef np.ndarray[np.int64_t] ccol = np.zeros(ncol,dtype=int)
-    cdef np.ndarray[np.float64_t] scol = np.zeros(ncol)
-    cdef np.ndarray[np.float64_t] sscol = np.zeros(ncol)
+    if ccol is None:
+        ccol = np.zeros(ncol,dtype=int)
+        scol = np.zeros(ncol)
+        sscol = np.zeros(ncol)
+    else:
+        assert ccol.shape[0] >= ncol and scol.shape[0] >= ncol \
+            and sscol.shape[0] >= ncol, "work arrays too small"
+        ccol[:ncol] = 0
+        scol[:ncol] = 0
+        sscol[:ncol] = 0
+
+    cdef np.ndarray[np.int64_t] _ccol = ccol
+    cdef np.ndarray[np.float64_t] _scol = scol
+    cdef np.ndarray[np.float64_t] _sscol = sscol
 
     # Loop over cadences
     for icad in range(ncad):
@@ -55,9 +72,9 @@ cpdef fold_col(np.ndarray[np.float64_t, ndim=1] data,
             icol = col[icad]
 
             # Increment counters
-            ccol[icol]+=1 
-            scol[icol]+=data[icad] 
-            sscol[icol]+=data[icad]**2
+            _ccol[icol]+=1 
+            _scol[icol]+=data[icad] 
+            _sscol[icol]+=data[icad]**2
 
     return ccol,scol,sscol
 
@@ -191,3 +208,768 @@ cpdef blscol1(np.ndarray[np.float64_t, ndim=1] data,
         if col1==ncol:
             col1 = 0 # If we're at the edge, go back to the begining
     return s2nmax,twdmax
+
+
+cdef inline void push_top(double[:, :] top, np.int64_t[:] ntop, 
+                          double[:] rest, int icol, int k, double v) nogil:
+    """
+    Insert v into the list of the k largest values of column icol
+
+    top[icol] is kept sorted in descending order. Whatever falls off
+    the list (either v or the smallest of the top values) is added to
+    rest[icol], so every value is summed exactly once.
+    """
+    cdef int j
+    if k==0:
+        rest[icol] += v
+        return
+
+    if ntop[icol] < k:
+        j = ntop[icol]
+        ntop[icol] += 1
+    elif v > top[icol, k-1]:
+        rest[icol] += top[icol, k-1]
+        j = k - 1
+    else:
+        rest[icol] += v
+        return
+
+    while j > 0 and v > top[icol, j-1]:
+        top[icol, j] = top[icol, j-1]
+        j -= 1
+    top[icol, j] = v
+
+
+cpdef cumsum_top(double[:, :] data, np.uint8_t[:, :] mask, int k):
+    """
+    Column sums with the top 0, 1, ..., k values removed
+
+    Streams through the (m,n) array once, keeping the k largest
+    non-masked values of each column and the sum of everything else.
+
+    Parameters
+    ----------
+    data : (float) ndim = 2
+    mask : (uint8) 1 = masked out
+    k : number of largest values to clip
+
+    Return
+    ------
+    datasum : shape = (k+1, n). datasum[i] is the column sum having
+        clipped the k-i largest values. datasum[-1] is the full sum.
+    datacnt : number of non-masked values entering datasum.
+    """
+    cdef int nrow, ncol, irow, icol, i
+    nrow = data.shape[0]
+    ncol = data.shape[1]
+
+    cdef double[:, :] top = np.zeros((ncol, max(k, 1)))
+    cdef np.int64_t[:] ntop = np.zeros(ncol, dtype=np.int64)
+    cdef double[:] rest = np.zeros(ncol)
+    cdef np.int64_t[:] ccol = np.zeros(ncol, dtype=np.int64)
+
+    datasum = np.zeros((k + 1, ncol))
+    datacnt = np.zeros((k + 1, ncol), dtype=int)
+    cdef double[:, :] _datasum = datasum
+    cdef np.int64_t[:, :] _datacnt = datacnt
+
+    with nogil:
+        for irow in range(nrow):
+            for icol in range(ncol):
+                if mask[irow, icol]==1:
+                    continue
+                ccol[icol] += 1
+                push_top(top, ntop, rest, icol, k, data[irow, icol])
+
+        # Add the top values back in, smallest first
+        for icol in range(ncol):
+            _datasum[0, icol] = rest[icol]
+            _datacnt[0, icol] = ccol[icol] - ntop[icol]
+            for i in range(1, k + 1):
+                _datasum[i, icol] = _datasum[i-1, icol]
+                _datacnt[i, icol] = _datacnt[i-1, icol]
+                if k - i < ntop[icol]:
+                    _datasum[i, icol] += top[icol, k-i]
+                    _datacnt[i, icol] += 1
+
+    return datasum, datacnt
+
+
+
+cpdef fold_plan(double[:] PcadG, int ncad):
+    """
+    Fold plan for a block of trial periods
+
+    The column of each cadence, floor(mod(icad, Pcad)), depends only on
+    the period. Computing it once lets the same plan be reused for
+    every trial duration.
+
+    Parameters
+    ----------
+    PcadG : (float) trial periods (cadences)
+    ncad : number of cadences
+
+    Return
+    ------
+    cols : (int32) shape = (nPcad, ncad). Column of each cadence.
+    ncols : (int32) number of columns for each trial period.
+    """
+    cdef int nPcad, iPcad, icad, icol
+    cdef double Pcad
+    nPcad = PcadG.shape[0]
+
+    cols = np.empty((nPcad, ncad), dtype=np.int32)
+    ncols = np.zeros(nPcad, dtype=np.int32)
+    cdef np.int32_t[:, :] _cols = cols
+    cdef np.int32_t[:] _ncols = ncols
+
+    with nogil:
+        for iPcad in range(nPcad):
+            Pcad = PcadG[iPcad]
+            for icad in range(ncad):
+                icol = <int> floor(fmod(icad, Pcad))
+                _cols[iPcad, icad] = icol
+                if icol + 1 > _ncols[iPcad]:
+                    _ncols[iPcad] = icol + 1
+
+    return cols, ncols
+
+@cython.cdivision(True)
+cpdef pgram_max_block(floating[:] data, np.uint8_t[:] mask, double[:] PcadG,
+                      double noise, np.int32_t[:, :] cols=None, 
+                      np.int32_t[:] ncols=None, double[:, :] work=None,
+                      np.int64_t[:, :] iwork=None, 
+                      np.int32_t[:, :] cand_col=None, 
+                      double[:, :] cand_s=None, double[:, :] cand_c=None,
+                      double[:] cand_floor=None):
+    """
+    Max periodogram over a block of trial periods
+
+    Equivalent to folding `data` on each period in `PcadG`, running
+    `cumsum_top` with k = 2 on the folded array, and selecting the
+    column with the highest s2n that survives the clipping
+    criteria. The 2-D folded array is never formed: each cadence is
+    assigned to its column with floor(mod(icad, Pcad)) and the column
+    counts, two largest values, and sum of the rest are accumulated
+    in a single pass (see push_top).
+
+    Parameters
+    ----------
+    data : (float32 or float64) single event statistic. Column sums are
+        accumulated in double precision either way.
+    mask : (uint8) mask for data array. 1 = masked out.
+    PcadG : (float) trial periods (cadences)
+    noise : noise on the twd timescale
+    cols, ncols : (optional) fold plan for PcadG from `fold_plan`. If
+        not given, columns are computed on the fly.
+    work, iwork : (optional) column work arrays with shape (ncol, 3)
+        and (ncol, 2), ncol >= floor(max(PcadG)) + 1. If not given,
+        they are allocated for this call.
+    cand_col, cand_s, cand_c, cand_floor : (optional) if given, filled
+        with the top K columns of each period that pass the cuts, for
+        use by pgram_max_update. See push_cand.
+
+    Return
+    ------
+    mean : mean depth of best column
+    s2n : s2n of best column
+    c : number of non-masked elements in best column
+    col : index of best column. -1 if no column passed the cuts.
+    """
+    cdef int ncad, nPcad, ncolmax, iPcad, icad, icol, ncol, colmax
+    cdef double Pcad, s, s1, s2, c, c1, c2, mean, s2n, s2nmax
+    cdef bint use_plan = cols is not None
+    cdef bint use_cand = cand_col is not None
+
+    ncad = data.shape[0]
+    nPcad = PcadG.shape[0]
+    ncolmax = 1
+    if nPcad > 0:
+        ncolmax = <int> floor(np.max(PcadG)) + 1
+    if use_plan:
+        assert cols.shape[0]==nPcad and cols.shape[1]==ncad, \
+            "fold plan does not match PcadG and data"
+    if use_cand:
+        assert cand_col.shape[0]==nPcad and cand_s.shape[0]==nPcad and \
+            cand_c.shape[0]==nPcad and cand_floor.shape[0]==nPcad, \
+            "candidate arrays do not match PcadG"
+
+    # Column work arrays, shared by all the periods in the block
+    if work is None:
+        work = np.zeros((ncolmax, 3))
+    if iwork is None:
+        iwork = np.zeros((ncolmax, 2), dtype=np.int64)
+    assert work.shape[0] >= ncolmax and work.shape[1] >= 3 and \
+        iwork.shape[0] >= ncolmax and iwork.shape[1] >= 2, \
+        "work arrays too small"
+    cdef double[:, :] top = work[:, 0:2]
+    cdef double[:] rest = work[:, 2]
+    cdef np.int64_t[:] ccol = iwork[:, 0]
+    cdef np.int64_t[:] ntop = iwork[:, 1]
+
+    cdef double[:] meanG = np.zeros(nPcad)
+    cdef double[:] s2nG = np.zeros(nPcad)
+    cdef double[:] cG = np.zeros(nPcad)
+    cdef np.int64_t[:] colG = np.zeros(nPcad, dtype=np.int64) - 1
+
+    with nogil:
+        for iPcad in range(nPcad):
+            Pcad = PcadG[iPcad]
+            ncol = 0
+            for icol in range(ncolmax):
+                ccol[icol] = 0
+                rest[icol] = 0.0
+                ntop[icol] = 0
+
+            if use_plan:
+                ncol = ncols[iPcad]
+            for icad in range(ncad):
+                if use_plan:
+                    icol = cols[iPcad, icad]
+                else:
+                    icol = <int> floor(fmod(icad, Pcad))
+                    if icol + 1 > ncol:
+                        ncol = icol + 1
+                if mask[icad]==1:
+                    continue
+                ccol[icol] += 1
+                push_top(top, ntop, rest, icol, 2, data[icad])
+
+            # Add the top values back in, in the same order as the
+            # cumulative sum in cumsum_top. Require 3 transits, so
+            # both top values are present.
+            s2nmax = 0.0
+            colmax = -1
+            if use_cand:
+                clear_cand(cand_col, cand_floor, iPcad)
+            for icol in range(ncol):
+                c = <double> ccol[icol]
+                if c < 3:
+                    continue
+
+                s2 = rest[icol]
+                s1 = s2 + top[icol, 1]
+                s = s1 + top[icol, 0]
+                c1 = c - 1
+                c2 = c - 2
+                mean = s / c
+                if not ((s1 / c1 > 0.5 * mean) and (s2 / c2 > 0.5 * mean)):
+                    continue
+
+                s2n = s / sqrt(c) / noise
+                if use_cand:
+                    push_cand(cand_col, cand_s, cand_c, cand_floor, iPcad,
+                              icol, s, c)
+                if colmax==-1 or s2n > s2nmax:
+                    s2nmax = s2n
+                    colmax = icol
+                    meanG[iPcad] = mean
+                    s2nG[iPcad] = s2n
+                    cG[iPcad] = c
+
+            colG[iPcad] = colmax
+
+    return (np.asarray(meanG), np.asarray(s2nG), np.asarray(cG),
+            np.asarray(colG))
+
+@cython.cdivision(True)
+cpdef bls_block(floating[:] data, np.uint8_t[:] mask, double[:] PcadG,
+                int twd1, int twd2, np.int32_t[:, :] cols=None, 
+                np.int32_t[:] ncols=None, double[:, :] work=None):
+    """
+    Box least squares periodogram over a block of trial periods
+
+    Equivalent to calling `fold_col` and `bls` for each period in
+    `PcadG`. For each period, the column counts, sums, and sums of
+    squares are accumulated in a single pass and turned into prefix
+    sums over the phase bins, extended by twd2 bins so that boxes can
+    wrap around. The statistics of any box are then the difference of
+    two prefix sums, independent of its width.
+
+    Parameters
+    ----------
+    data : (float32 or float64) data array. Column statistics are
+        accumulated in double precision either way.
+    mask : (uint8) mask for data array. 1 = masked out.
+    PcadG : (float) trial periods (cadences)
+    twd1, twd2 : range of box widths (columns) to search, inclusive
+    cols, ncols : (optional) fold plan for PcadG from `fold_plan`. If
+        not given, columns are computed on the fly.
+    work : (optional) prefix sum work array with shape (ncol + twd2 + 1,
+        3), ncol >= floor(max(PcadG)) + 1. If not given, it is
+        allocated for this call.
+
+    Return
+    ------
+    s2n, twd, col, mean, noise : for each period, the box with the
+        highest s2n = -mean / noise. -1 if no box has more points than
+        its width.
+    """
+    cdef int ncad, nPcad, ncolmax, iPcad, icad, icol, ncol, i, col0, twd
+    cdef int twdmax, colmax
+    cdef double Pcad, c, s, ss, x, mean, std, noise, s2n, s2nmax
+    cdef double noisemax, meanmax
+    cdef bint use_plan = cols is not None
+
+    ncad = data.shape[0]
+    nPcad = PcadG.shape[0]
+    ncolmax = 1
+    if nPcad > 0:
+        ncolmax = <int> floor(np.max(PcadG)) + 1
+    if use_plan:
+        assert cols.shape[0]==nPcad and cols.shape[1]==ncad, \
+            "fold plan does not match PcadG and data"
+
+    # Column sums in rows 1 to ncol, then prefix sums in place
+    if work is None:
+        work = np.zeros((ncolmax + twd2 + 1, 3))
+    assert work.shape[0] >= ncolmax + twd2 + 1 and work.shape[1] >= 3, \
+        "work array too small"
+
+    cdef double[:] s2nG = np.zeros(nPcad) - 1
+    cdef np.int64_t[:] twdG = np.zeros(nPcad, dtype=np.int64) - 1
+    cdef np.int64_t[:] colG = np.zeros(nPcad, dtype=np.int64) - 1
+    cdef double[:] meanG = np.zeros(nPcad) - 1
+    cdef double[:] noiseG = np.zeros(nPcad) - 1
+
+    with nogil:
+        for iPcad in range(nPcad):
+            Pcad = PcadG[iPcad]
+            ncol = 0
+            for i in range(ncolmax + twd2 + 1):
+                work[i, 0] = 0.0
+                work[i, 1] = 0.0
+                work[i, 2] = 0.0
+
+            if use_plan:
+                ncol = ncols[iPcad]
+            for icad in range(ncad):
+                if use_plan:
+                    icol = cols[iPcad, icad]
+                else:
+                    icol = <int> floor(fmod(icad, Pcad))
+                    if icol + 1 > ncol:
+                        ncol = icol + 1
+                if mask[icad]==1:
+                    continue
+                x = data[icad]
+                work[icol + 1, 0] += 1.0
+                work[icol + 1, 1] += x
+                work[icol + 1, 2] += x * x
+
+            # Wrap the column sums around, then accumulate
+            for i in range(ncol + 1, ncol + twd2 + 1):
+                icol = (i - 1) % ncol
+                work[i, 0] = work[icol + 1, 0]
+                work[i, 1] = work[icol + 1, 1]
+                work[i, 2] = work[icol + 1, 2]
+            for i in range(1, ncol + twd2 + 1):
+                work[i, 0] += work[i - 1, 0]
+                work[i, 1] += work[i - 1, 1]
+                work[i, 2] += work[i - 1, 2]
+
+            # Same search order and cuts as bls
+            s2nmax = -1.0
+            twdmax = -1
+            colmax = -1
+            noisemax = -1.0
+            meanmax = -1.0
+            for col0 in range(ncol):
+                for twd in range(twd1, twd2 + 1):
+                    c = work[col0 + twd, 0] - work[col0, 0]
+                    if not c > twd:
+                        continue
+                    s = work[col0 + twd, 1] - work[col0, 1]
+                    ss = work[col0 + twd, 2] - work[col0, 2]
+                    mean = s / c
+                    std = sqrt( (c * ss - s * s) / (c * (c - 1)) )
+                    noise = std / sqrt(c)
+                    s2n = -1.0 * mean / noise
+                    if s2n > s2nmax:
+                        s2nmax = s2n
+                        twdmax = twd
+                        colmax = col0
+                        noisemax = noise
+                        meanmax = mean
+
+            s2nG[iPcad] = s2nmax
+            twdG[iPcad] = twdmax
+            colG[iPcad] = colmax
+            meanG[iPcad] = meanmax
+            noiseG[iPcad] = noisemax
+
+    return (np.asarray(s2nG), np.asarray(twdG), np.asarray(colG), 
+            np.asarray(meanG), np.asarray(noiseG))
+
+@cython.cdivision(True)
+cpdef foreman_mackey_block(np.uint8_t[:, :] good, floating[:, :] depth, 
+                           floating[:, :] ivar, floating[:, :] dll, 
+                           double[:] PcadG, double alpha, 
+                           np.int32_t[:, :] cols=None, 
+                           np.int32_t[:] ncols=None, double[:, :] work=None):
+    """
+    Foreman-Mackey periodogram over a block of trial periods
+
+    Combines the single transit fits (see
+    tfind.foreman_mackey_1d_batch) at every phase of every trial
+    period and duration. With d_i, w_i, and dll_i the depth, inverse
+    variance, and delta log-likelihood of the nind good transits in a
+    column, the inverse variance weighted depth is
+
+        depth_2d = sum(w_i d_i) / sum(w_i),  depth_ivar_2d = sum(w_i)
+
+    and the two models are compared with a penalty of alpha / 2 per
+    depth parameter:
+
+        phic_same = sum(dll_i) - 0.5 sum(w_i (d_i - depth_2d)**2) 
+                    - 0.5 alpha
+        phic_variable = sum(dll_i) - 0.5 alpha nind
+
+    For each period, returns the column and duration with the highest
+    phic_same among those with depth_2d > 0, phic_same >
+    phic_variable, and nind >= 2. Durations are scanned in order and
+    columns in order within each duration.
+
+    Parameters
+    ----------
+    good : (uint8) shape = (ntwd, ncad). 1 for good transits.
+    depth, ivar, dll : (float32 or float64) shape = (ntwd, ncad). Single
+        transit depth, inverse variance, and delta log-likelihood.
+        Sums are accumulated in double precision either way.
+    PcadG : (float) trial periods (cadences)
+    alpha : penalty per depth parameter
+    cols, ncols : (optional) fold plan for PcadG from `fold_plan`. If
+        not given, columns are computed on the fly.
+    work : (optional) column work array with shape (ncol, 5), ncol >=
+        floor(max(PcadG)) + 1. If not given, it is allocated for this
+        call.
+
+    Return
+    ------
+    phic_same, phic_variable, depth_2d, depth_ivar_2d, nind, col, itwd :
+        values at the best column and duration of each period. itwd
+        and col are -1 if nothing passed the cuts.
+    """
+    cdef int ncad, ntwd, nPcad, ncolmax, iPcad, itwd, icad, icol, ncol
+    cdef double Pcad, w, d, n, sw, swd, swdd, sdll, D, same, variable
+    cdef bint use_plan = cols is not None
+
+    ntwd = depth.shape[0]
+    ncad = depth.shape[1]
+    nPcad = PcadG.shape[0]
+    ncolmax = 1
+    if nPcad > 0:
+        ncolmax = <int> floor(np.max(PcadG)) + 1
+    if use_plan:
+        assert cols.shape[0]==nPcad and cols.shape[1]==ncad, \
+            "fold plan does not match PcadG and data"
+    if work is None:
+        work = np.zeros((ncolmax, 5))
+    assert work.shape[0] >= ncolmax and work.shape[1] >= 5, \
+        "work array too small"
+
+    cdef double[:] sameG = np.zeros(nPcad)
+    cdef double[:] variableG = np.zeros(nPcad)
+    cdef double[:] depthG = np.zeros(nPcad)
+    cdef double[:] ivarG = np.zeros(nPcad)
+    cdef double[:] nindG = np.zeros(nPcad)
+    cdef np.int64_t[:] colG = np.zeros(nPcad, dtype=np.int64) - 1
+    cdef np.int64_t[:] itwdG = np.zeros(nPcad, dtype=np.int64) - 1
+
+    with nogil:
+        for iPcad in range(nPcad):
+            Pcad = PcadG[iPcad]
+            for itwd in range(ntwd):
+                for icol in range(ncolmax):
+                    work[icol, 0] = 0.0
+                    work[icol, 1] = 0.0
+                    work[icol, 2] = 0.0
+                    work[icol, 3] = 0.0
+                    work[icol, 4] = 0.0
+
+                ncol = 0
+                if use_plan:
+                    ncol = ncols[iPcad]
+                for icad in range(ncad):
+                    if use_plan:
+                        icol = cols[iPcad, icad]
+                    else:
+                        icol = <int> floor(fmod(icad, Pcad))
+                        if icol + 1 > ncol:
+                            ncol = icol + 1
+                    if good[itwd, icad]==0:
+                        continue
+                    w = ivar[itwd, icad]
+                    d = depth[itwd, icad]
+                    work[icol, 0] += 1.0
+                    work[icol, 1] += w
+                    work[icol, 2] += w * d
+                    work[icol, 3] += w * d * d
+                    work[icol, 4] += dll[itwd, icad]
+
+                for icol in range(ncol):
+                    n = work[icol, 0]
+                    sw = work[icol, 1]
+                    if n < 2 or not sw > 0:
+                        continue
+                    swd = work[icol, 2]
+                    swdd = work[icol, 3]
+                    sdll = work[icol, 4]
+
+                    # sum(w (d - D)**2) = sum(w d**2) - D**2 sum(w)
+                    D = swd / sw
+                    same = sdll - 0.5 * (swdd - D * D * sw) - 0.5 * alpha
+                    variable = sdll - 0.5 * alpha * n
+                    if not (D > 0 and same > variable):
+                        continue
+                    if itwdG[iPcad]==-1 or same > sameG[iPcad]:
+                        sameG[iPcad] = same
+                        variableG[iPcad] = variable
+                        depthG[iPcad] = D
+                        ivarG[iPcad] = sw
+                        nindG[iPcad] = n
+                        colG[iPcad] = icol
+                        itwdG[iPcad] = itwd
+
+    return (np.asarray(sameG), np.asarray(variableG), np.asarray(depthG),
+            np.asarray(ivarG), np.asarray(nindG), np.asarray(colG),
+            np.asarray(itwdG))
+
+cdef inline void clear_cand(np.int32_t[:, :] cand_col, double[:] cand_floor,
+                            int i) nogil:
+    cdef int j
+    for j in range(cand_col.shape[1]):
+        cand_col[i, j] = -1
+    cand_floor[i] = -INFINITY
+
+cdef inline void push_cand(np.int32_t[:, :] cand_col, double[:, :] cand_s, 
+                           double[:, :] cand_c, double[:] cand_floor, 
+                           int i, int col, double s, double c) nogil:
+    """
+    Insert a column into the candidate list of period i
+
+    The K candidates (col = -1 marks an empty slot) are kept in order
+    of decreasing z = s / sqrt(c), which is s2n without the noise, and
+    increasing column for equal z. cand_floor[i] is the largest z that
+    has fallen off the list, so the list holds every passing column
+    with z > cand_floor[i].
+    """
+    cdef int K = cand_col.shape[1]
+    cdef int j, k
+    cdef double z = s / sqrt(c)
+    cdef double zj
+
+    for j in range(K):
+        if cand_col[i, j] < 0:
+            break
+        zj = cand_s[i, j] / sqrt(cand_c[i, j])
+        if z > zj or (z==zj and col < cand_col[i, j]):
+            break
+    else:
+        j = K
+
+    if j==K:
+        if z > cand_floor[i]:
+            cand_floor[i] = z
+        return
+
+    if cand_col[i, K-1] >= 0:
+        zj = cand_s[i, K-1] / sqrt(cand_c[i, K-1])
+        if zj > cand_floor[i]:
+            cand_floor[i] = zj
+
+    for k in range(K - 1, j, -1):
+        cand_col[i, k] = cand_col[i, k-1]
+        cand_s[i, k] = cand_s[i, k-1]
+        cand_c[i, k] = cand_c[i, k-1]
+    cand_col[i, j] = col
+    cand_s[i, j] = s
+    cand_c[i, j] = c
+
+cdef inline bint column_passes(double c, double top0, double top1, 
+                               double rest, double* s) nogil:
+    """
+    Clipping cuts of pgram_max_block. Sets s to the column sum.
+    """
+    cdef double s1, s2, mean
+    if c < 3:
+        return False
+    s2 = rest
+    s1 = s2 + top1
+    s[0] = s1 + top0
+    mean = s[0] / c
+    return (s1 / (c - 1) > 0.5 * mean) and (s2 / (c - 2) > 0.5 * mean)
+
+@cython.cdivision(True)
+cpdef pgram_max_update(floating[:] data, np.uint8_t[:] mask, double[:] PcadG,
+                       double noise, np.int64_t[:] icad_aff, 
+                       np.int32_t[:, :] cand_col, double[:, :] cand_s, 
+                       double[:, :] cand_c, double[:] cand_floor):
+    """
+    Update pgram_max_block after the data changed at a few cadences
+
+    Only the columns that contain a cadence in `icad_aff` are folded
+    again. Each column holds at most one cadence per row, ceil(r * Pcad
+    + icol) for row r, so a column costs ~ncad / Pcad. The new column
+    sums are merged with the stored candidates from the unaffected
+    columns (see push_cand), whose sums have not changed. If the best
+    candidate does not beat cand_floor, an unstored column could win,
+    and the whole period is folded again. This also happens when the
+    affected columns would cost more than half a full fold.
+
+    Parameters
+    ----------
+    data, mask, PcadG, noise : new data, see pgram_max_block
+    icad_aff : (int) cadences where data or mask changed
+    cand_col, cand_s, cand_c, cand_floor : candidates from the previous
+        call to pgram_max_block or pgram_max_update for the same
+        PcadG. Updated in place.
+
+    Return
+    ------
+    mean, s2n, c, col : see pgram_max_block
+    nfull : number of periods that were folded again in full
+    """
+    cdef int ncad, nPcad, ncolmax, naff, K, iPcad, i, j, k, icol, ncol
+    cdef int icad, irow, nrow, nfull, jcol
+    cdef double Pcad, c, s, t0, t1, rest, v, floor_old
+    cdef bint full
+
+    ncad = data.shape[0]
+    nPcad = PcadG.shape[0]
+    naff = icad_aff.shape[0]
+    K = cand_col.shape[1]
+    ncolmax = 1
+    if nPcad > 0:
+        ncolmax = <int> floor(np.max(PcadG)) + 1
+
+    cdef np.uint8_t[:] colflag = np.zeros(ncolmax, dtype=np.uint8)
+    cdef np.int64_t[:] affcol = np.zeros(max(naff, 1), dtype=np.int64)
+    cdef np.int32_t[:] oldcol = np.zeros(K, dtype=np.int32)
+    cdef double[:] olds = np.zeros(K)
+    cdef double[:] oldc = np.zeros(K)
+
+    cdef np.int64_t[:] ccol = np.zeros(ncolmax, dtype=np.int64)
+    cdef double[:] crest = np.zeros(ncolmax)
+    cdef double[:, :] top = np.zeros((ncolmax, 2))
+    cdef np.int64_t[:] ntop = np.zeros(ncolmax, dtype=np.int64)
+
+    cdef double[:] meanG = np.zeros(nPcad)
+    cdef double[:] s2nG = np.zeros(nPcad)
+    cdef double[:] cG = np.zeros(nPcad)
+    cdef np.int64_t[:] colG = np.zeros(nPcad, dtype=np.int64) - 1
+
+    nfull = 0
+    with nogil:
+        for iPcad in range(nPcad):
+            Pcad = PcadG[iPcad]
+            nrow = <int> ceil(ncad / Pcad)
+
+            # Columns touched by the changed cadences
+            ncol = 0
+            for i in range(naff):
+                icol = <int> floor(fmod(icad_aff[i], Pcad))
+                if colflag[icol]==0:
+                    colflag[icol] = 1
+                    affcol[ncol] = icol
+                    ncol += 1
+
+            full = Pcad < 2 or 2 * ncol * (nrow + 1) > ncad
+            if not full:
+                floor_old = cand_floor[iPcad]
+                for k in range(K):
+                    oldcol[k] = cand_col[iPcad, k]
+                    olds[k] = cand_s[iPcad, k]
+                    oldc[k] = cand_c[iPcad, k]
+                clear_cand(cand_col, cand_floor, iPcad)
+                cand_floor[iPcad] = floor_old
+
+                # Unaffected candidates keep their sums
+                for k in range(K):
+                    if oldcol[k] >= 0 and colflag[oldcol[k]]==0:
+                        push_cand(cand_col, cand_s, cand_c, cand_floor, 
+                                  iPcad, oldcol[k], olds[k], oldc[k])
+
+                # Fold the affected columns again. Round off in x can
+                # move ceil(x) by one either way, so check its neighbors.
+                for j in range(ncol):
+                    jcol = affcol[j]
+                    c = 0
+                    t0 = 0
+                    t1 = 0
+                    rest = 0
+                    for irow in range(nrow + 1):
+                        icad = <int> ceil(irow * Pcad + jcol) - 1
+                        for i in range(3):
+                            if icad < 0 or icad >= ncad or mask[icad]==1 or \
+                               <int> floor(fmod(icad, Pcad))!=jcol:
+                                icad += 1
+                                continue
+                            v = data[icad]
+                            icad += 1
+                            c += 1
+                            if c==1:
+                                t0 = v
+                            elif c==2:
+                                if v > t0:
+                                    t1 = t0
+                                    t0 = v
+                                else:
+                                    t1 = v
+                            elif v > t0:
+                                rest += t1
+                                t1 = t0
+                                t0 = v
+                            elif v > t1:
+                                rest += t1
+                                t1 = v
+                            else:
+                                rest += v
+
+                    if column_passes(c, t0, t1, rest, &s):
+                        push_cand(cand_col, cand_s, cand_c, cand_floor, 
+                                  iPcad, jcol, s, c)
+
+                # The list must account for every column that could win
+                if cand_col[iPcad, 0] >= 0:
+                    full = not (cand_s[iPcad, 0] / sqrt(cand_c[iPcad, 0]) 
+                                > cand_floor[iPcad])
+                else:
+                    full = cand_floor[iPcad] > -INFINITY
+
+            for j in range(ncol):
+                colflag[affcol[j]] = 0
+
+            if full:
+                nfull += 1
+                clear_cand(cand_col, cand_floor, iPcad)
+                ncol = 0
+                for icol in range(ncolmax):
+                    ccol[icol] = 0
+                    crest[icol] = 0.0
+                    ntop[icol] = 0
+                for icad in range(ncad):
+                    icol = <int> floor(fmod(icad, Pcad))
+                    if icol + 1 > ncol:
+                        ncol = icol + 1
+                    if mask[icad]==1:
+                        continue
+                    ccol[icol] += 1
+                    push_top(top, ntop, crest, icol, 2, data[icad])
+                for icol in range(ncol):
+                    c = <double> ccol[icol]
+                    if column_passes(c, top[icol, 0], top[icol, 1], 
+                                     crest[icol], &s):
+                        push_cand(cand_col, cand_s, cand_c, cand_floor, 
+                                  iPcad, icol, s, c)
+
+            if cand_col[iPcad, 0] >= 0:
+                c = cand_c[iPcad, 0]
+                s = cand_s[iPcad, 0]
+                meanG[iPcad] = s / c
+                s2nG[iPcad] = s / sqrt(c) / noise
+                cG[iPcad] = c
+                colG[iPcad] = cand_col[iPcad, 0]
+
+    return (np.asarray(meanG), np.asarray(s2nG), np.asarray(cG),
+            np.asarray(colG), nfull)
@@ -0,0 +1,222 @@
+"""
+Batch processing
+
+Run the pipeline (preprocess, grid_search and fit_transits for each
+candidate) on many stars with a persistent pool of worker processes.
+The pipeline modules (pandas, lmfit, batman, ...) are imported once by
+the parent before the pool starts and inherited by the workers, which
+are reused for every star. The parameter database is read once, and
+each result is inserted into the results database as soon as the star
+is done.
+
+    $ terra batch stars.txt pars.sqlite results.sqlite \\
+          --phot 'phot/{}.fits' --outdir grid/ --nproc 16
+"""
+import os
+import sqlite3
+import time
+import traceback
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import pipeline
+import tfind
+
+def read_starlist(starlist):
+    """Read star names, one per line. Blank lines and # are skipped"""
+    with open(starlist) as f:
+        lines = [line.split('#')[0].strip() for line in f]
+    return [line for line in lines if len(line) > 0]
+
+def read_params(parfile, starnames, tables=['grid']):
+    """Read runtime parameters for a list of stars
+
+    Args:
+        parfile (str): sqlite file with one table per pipeline stage,
+            indexed by the `id` column (see bin/terra)
+        starnames (list): star ids
+        tables (Optional[list]): tables to read. Only grid (P1, P2,
+            fluxField, fluxMask) is used by the pipeline; the pp and dv
+            tables configure the old terra module and have no
+            counterpart in pipeline.preprocess or fit_transits.
+
+    Returns:
+        params (dict): params[starname][table] is a dict of parameters
+    """
+    con = sqlite3.connect(parfile)
+    params = dict([(starname, {}) for starname in starnames])
+    for table in tables:
+        df = pd.read_sql('select * from {}'.format(table), con, index_col='id')
+        df.index = df.index.astype(str)
+        missing = set(starnames) - set(df.index)
+        assert len(missing)==0, \
+            "{} missing from table {}".format(list(missing)[:5], table)
+
+        for starname in starnames:
+            params[starname][table] = dict(df.ix[starname])
+
+    con.close()
+    return params
+
+def run_star(job):
+    """Run the pipeline on a single star
+
+    Errors are caught and returned as part of the result, so that one
+    bad light curve does not stop the batch. The single event
+    statistic cache (tfind.mtd_cache) is reset before and after each
+    star, so a worker does not hold on to previous light curves.
+
+    Args:
+        job (tuple): starname, params (see read_params), path_phot,
+            outdir, max_planets. Up to max_planets candidates are
+            searched for with pipeline.search_planets. If outdir is
+            not None, the pipeline of each candidate is written to
+            <outdir>/<starname>.<nplanet>.h5 and the cache spills to
+            <outdir>/<starname>.mtd.h5, which is removed when the star
+            is done.
+
+    Returns:
+        results (list): one dict per candidate with the header values
+            of the pipeline plus starname, numplanet, status ('ok' or
+            'failed'), error, and time (seconds). A star that fails
+            ends with a failed entry.
+    """
+    starname, params, path_phot, outdir, max_planets = job
+    start = time.time()
+    results = []
+    result = dict(starname=starname, numplanet=1, status='ok', error=None)
+    spill_file = None
+    if outdir is not None:
+        spill_file = os.path.join(outdir, '{}.mtd.h5'.format(starname))
+    tfind.mtd_cache.reset(spill_file=spill_file)
+    try:
+        par = params['grid']
+        lc = pipeline.read_lightcurve(
+            path_phot, fluxfield=par['fluxField'], fluxmask=par['fluxMask']
+        )
+        header = dict(path_phot=path_phot)
+        pipe = pipeline.Pipeline(lc=lc, starname=starname, header=header)
+        pipeline.preprocess(pipe)
+        planets = pipeline.search_planets(
+            pipe, P1=par['P1'], P2=par['P2'], max_planets=max_planets
+        )
+        for nplanet in planets:
+            if outdir is not None:
+                h5file = os.path.join(
+                    outdir, '{}.{:02d}.h5'.format(starname, nplanet)
+                )
+                pipe.to_hdf(h5file, '/')
+            result['numplanet'] = nplanet
+            result['time'] = time.time() - start
+            results.append(dict(pipe.header['value'], **result))
+            result['numplanet'] = nplanet + 1
+
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+        result['time'] = time.time() - start
+        results.append(result)
+    finally:
+        tfind.mtd_cache.reset()
+        if spill_file is not None and os.path.exists(spill_file):
+            os.remove(spill_file)
+
+    return results
+
+def insert_result(con, result, table='results'):
+    """Insert one result into the results database
+
+    The table is created on the first insert and columns are added as
+    new header values show up, so stars that fail early and stars that
+    finish can share the table.
+    """
+    result = dict([(k, _sqlite_value(v)) for k, v in result.iteritems()])
+    with con:
+        cur = con.cursor()
+        cur.execute(
+            'CREATE TABLE IF NOT EXISTS {} (starname TEXT)'.format(table)
+        )
+        cur.execute('PRAGMA table_info({})'.format(table))
+        columns = [row[1] for row in cur.fetchall()]
+        for key in result.keys():
+            if columns.count(key)==0:
+                cur.execute(
+                    'ALTER TABLE {} ADD COLUMN [{}]'.format(table, key)
+                )
+
+        keys = result.keys()
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table,
+            ', '.join(['[{}]'.format(k) for k in keys]),
+            ', '.join(['?'] * len(keys))
+        )
+        cur.execute(sql, [result[k] for k in keys])
+
+def _sqlite_value(value):
+    """Convert numpy scalars to types sqlite understands"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def batch(starnames, parfile, resultsdb, path_phot, outdir=None, nproc=None,
+          max_planets=1):
+    """Run the pipeline on a list of stars
+
+    Args:
+        starnames (list): star ids, must be in the grid table of parfile
+        parfile (str): sqlite file with the grid parameters
+        resultsdb (str): sqlite file to store results in
+        path_phot (str): path to the photometry, with {} in place of
+            the star name, e.g. 'phot/{}.fits'
+        outdir (Optional[str]): directory for the pipeline h5 files.
+            If None, only the results database is written.
+        nproc (Optional[int]): number of workers. Defaults to the
+            number of cores.
+        max_planets (Optional[int]): candidates to search for per
+            star, see pipeline.search_planets
+
+    Returns:
+        results (pandas DataFrame): one row per candidate in order of
+            completion
+    """
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    if outdir is not None and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    params = read_params(parfile, starnames)
+    jobs = [
+        (starname, params[starname], path_phot.format(starname), outdir,
+         max_planets)
+        for starname in starnames
+    ]
+
+    # The fitting modules are imported on first use. Import them here
+    # so the workers inherit them instead of importing them each.
+    import lmfit
+    import batman
+
+    con = sqlite3.connect(resultsdb, 60)
+    pool = multiprocessing.Pool(nproc)
+    results = []
+    for i, star_results in enumerate(pool.imap_unordered(run_star, jobs)):
+        for result in star_results:
+            insert_result(con, result)
+            results.append(result)
+
+        # No results if max_planets is 0
+        if len(star_results)==0:
+            continue
+
+        result = star_results[-1]
+        print "batch: {}/{} {} {} planets {} ({:.1f} s)".format(
+            i + 1, len(jobs), result['starname'], result['numplanet'],
+            result['status'], result['time']
+        )
+
+    pool.close()
+    pool.join()
+    con.close()
+    return pd.DataFrame(results)
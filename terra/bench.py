@@ -0,0 +1,212 @@
+"""
+Benchmarks
+
+Timing and regression checks for the transit search, run on the K2
+light curve bundled in tests/data. For example:
+
+    >>> from terra import bench
+    >>> bench.precision()
+    >>> bench.import_time()
+    >>> bench.transit_model_fit()
+    >>> bench.label_transit()
+"""
+import ast
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+from numpy import ma
+import pandas as pd
+
+import pipeline
+import tfind
+import tval
+
+test_fitsfile = os.path.join(
+    os.path.dirname(__file__), 'tests/data/201367065.fits'
+)
+
+def load_test_lc(fitsfile=test_fitsfile, fluxfield='fdt_t_roll_2D'):
+    """Load a light curve produced by k2phot
+
+    Reads the file with pipeline.read_lightcurve, so missing cadences
+    are filled in with masked points as in the pipeline.
+
+    Args:
+        fitsfile (str) : path to fits file
+        fluxfield (str) : column with the detrended flux
+
+    Returns:
+        t (numpy array) : time
+        fm (masked array) : median subtracted flux, fill_value = 0
+    """
+    lc = pipeline.read_lightcurve(fitsfile, fluxfield=fluxfield)
+    t = np.array(lc.t)
+    fm = ma.masked_array(np.array(lc.f), np.array(lc.fmask), fill_value=0)
+    fm -= ma.median(fm)
+    return t, fm
+
+def precision(fitsfile=test_fitsfile, P1=0.5, P2=None, mode='max', nseg=10):
+    """Compare single and double precision periodograms
+
+    Runs the grid search in both precision modes of tfind.Grid and
+    reports the run time and the peak s2n, P, and t0 of each.
+
+    Returns:
+        res (pandas DataFrame) : one row per precision mode
+    """
+    t, fm = load_test_lc(fitsfile)
+    tbase = t.ptp()
+    if P2 is None:
+        P2 = 0.49 * tbase
+
+    pgram_params = tfind.periodogram_parameters(P1, P2, tbase, nseg=nseg)
+    res = []
+    for precision in ['double','single']:
+        grid = tfind.Grid(t, fm, precision=precision)
+        start = time.time()
+        pgram = grid.periodogram(pgram_params, mode=mode)
+        elapsed = time.time() - start
+        row = pgram.sort_values('s2n').iloc[-1]
+        res.append(
+            dict(precision=precision, time=elapsed, s2n=row['s2n'],
+                 P=row['P'], t0=row['t0'])
+        )
+
+    res = pd.DataFrame(res).set_index('precision')
+    ref = res.ix['double']
+    for key in 's2n P t0'.split():
+        res['d'+key] = (res[key] - ref[key]) / ref[key]
+
+    print res.to_string()
+    return res
+
+# Heavy dependencies that should only be imported on first use
+lazy_modules = [
+    'astropy', 'batman', 'emcee', 'lmfit', 'matplotlib.pyplot', 'sklearn', 
+    'scipy.signal'
+]
+
+_import_code = """
+import sys, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+loaded = [m for m in {lazy_modules!r} if m in sys.modules]
+sys.stdout.write(repr((elapsed, loaded)))
+"""
+
+def import_time(modules=['terra.tfind', 'terra.tval', 'terra.transit_model',
+                         'terra.cotrend', 'terra.pipeline'], nrepeat=3):
+    """Time importing terra modules in a fresh interpreter
+
+    Each module is imported nrepeat times, each in a new python
+    process, so nothing is cached from a previous import.
+
+    Returns:
+        res (pandas DataFrame): one row per module with the best time
+            (seconds) and the lazy_modules that the import pulled in
+    """
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    res = []
+    for module in modules:
+        code = _import_code.format(module=module, lazy_modules=lazy_modules)
+        times = []
+        for i in range(nrepeat):
+            out = subprocess.check_output(
+                [sys.executable, '-c', code], cwd=topdir
+            )
+            elapsed, loaded = ast.literal_eval(out.strip().split('\n')[-1])
+            times.append(elapsed)
+        res.append(dict(module=module, time=min(times), loaded=loaded))
+
+    res = pd.DataFrame(res).set_index('module')[['time','loaded']]
+    print res.to_string()
+    return res
+
+def test_import_time():
+    """The terra modules must not import lazy_modules at import time"""
+    res = import_time(nrepeat=1)
+    for module, row in res.iterrows():
+        assert len(row['loaded'])==0, \
+            "import {} loads {}".format(module, row['loaded'])
+
+def transit_model_fit(nfev=2000, cache_sizes=[0, 8]):
+    """Nelder-Mead evaluations per second of tval.TransitModel
+
+    Fits a synthetic, supersampled transit like the constant ephemeris
+    fit in pipeline.fit_transits, with the batman model cache disabled
+    (cache size 0) and enabled.
+
+    Returns:
+        res (pandas DataFrame): one row per cache size with the number
+            of evaluations, the run time, and evaluations per second
+    """
+    from lmfit import minimize
+    batman_kw = dict(supersample_factor=4, exp_time=1.0/48.0)
+    # eight transits, one day around each
+    t = np.arange(-0.5, 79.5, 1.0/48.0)
+    t = t[np.abs((t + 5.0) % 10.0 - 5.0) < 0.5]
+    tm = tval.TransitModel(10.0, 0.0, 0.05, 0.15, 0.3, batman_kw=batman_kw)
+    np.random.seed(0)
+    ferr = np.zeros(t.size) + 1e-4
+    f = tm.model(tm.lm_params, t) + np.random.randn(t.size) * ferr
+    tm.lm_params['per'].vary = False
+
+    res = []
+    for cache_size in cache_sizes:
+        tm.batman_cache_size = cache_size
+        params = tm.lm_params.copy()
+        params['t0'].value = 0.01
+        params['rp'].value = 0.04
+        start = time.time()
+        out = minimize(
+            tm.residual, params, args=(t, f, ferr), method='nelder',
+            options=dict(maxfev=nfev)
+        )
+        elapsed = time.time() - start
+        res.append(
+            dict(cache_size=cache_size, nfev=out.nfev, time=elapsed,
+                 rate=out.nfev / elapsed)
+        )
+
+    res = pd.DataFrame(res).set_index('cache_size')
+    print res.to_string()
+    return res
+
+def label_transit(periods=[0.5, 1.0, 3.0, 10.0], tbase=4 * 365.25, 
+                  nrepeat=3):
+    """Time tval.label_transit at short periods
+
+    Uses Kepler long cadence sampling over tbase days, with the
+    labeling used by pipeline.fit_transits.
+
+    Returns:
+        res (pandas DataFrame): one row per period with the number of
+            transits and the best time (seconds)
+    """
+    t = np.arange(0, tbase, 29.4 / 60 / 24)
+    res = []
+    for P in periods:
+        tdur = 0.1 * P**(1.0/3)
+        times = []
+        for i in range(nrepeat):
+            start = time.time()
+            labels = tval.label_transit(t, P, 0.3, 2 * tdur, cpad=0, cfrac=2)
+            times.append(time.time() - start)
+        res.append(
+            dict(P=P, ntransits=labels['transit_id'].max() + 1, 
+                 time=min(times))
+        )
+
+    res = pd.DataFrame(res).set_index('P')
+    print res.to_string()
+    return res
+
+if __name__=='__main__':
+    precision()
+    import_time()
+    transit_model_fit()
+    label_transit()
@@ -1,25 +1,24 @@
 """
 Cotrending code
+
+pylab, sklearn, and the plotting helpers are imported by the functions
+that use them, so that importing this module (e.g. through prepro)
+stays cheap.
 """
 import glob
 
 from matplotlib import mlab
-from matplotlib.gridspec import GridSpec
-from matplotlib.pylab import *
-from matplotlib.transforms import blended_transform_factory as btf
-
+import numpy as np
+from numpy import ma, arange, median, newaxis
 from scipy import optimize
 from scipy import ndimage as nd
-from sklearn.decomposition import FastICA, PCA
 import pandas as pd
-import h5py
 
 import tfind
 import detrend
 import keplerio
 import prepro
 from utils import h5plus
-from utils.plotplus import AddAnchored
 from config import nMode,sigOut,maxIt#,path_phot
 
 def dtbvfitm(t,fm,bv):
@@ -203,6 +202,7 @@ def robust_components(M0,n_components=4,algo='PCA'):
     M : d x n matrix of observations, where d is the dimensionality of
         the measurements, and n is the number of measurements
     """
+    from sklearn.decomposition import FastICA, PCA
 
     M = M0.copy()
     d,n = M0.shape
@@ -443,6 +443,10 @@ class EnsembleCalibrator:
         return A,fcbv
 
     def plot_modes_diag(self, fdt, step=0.001):
+        from matplotlib.pylab import figure, legend, plot, plt, sca, setp
+        from matplotlib.gridspec import GridSpec
+        from utils.plotplus import AddAnchored
+
         # Compute the fits
         U = self.U
         n_components = U.shape[1]
@@ -545,6 +549,7 @@ def read_hdf(h5file):
 
 # Plotting functions
 def plot_mode_FOV(dfA,kAs):
+    from matplotlib.pylab import sca, scatter, subplots, title
     fig,axL = subplots(ncols=4, nrows=2)
     for i,k in zip(range(len(kAs)),kAs):
         sca(axL.flatten()[i])
@@ -553,6 +558,8 @@ def plot_mode_FOV(dfA,kAs):
         print dfA[('ra dec %s' % k).split()]
 
 def plot_PCs(U,V):
+    from matplotlib.pylab import figure, hist, plot, sca
+    from matplotlib.gridspec import GridSpec
     fig = figure(figsize=(20,12))
     nPC = U.shape[1]
     gs = GridSpec(nPC,nPC+1)
@@ -568,6 +575,7 @@ def plot_PCs(U,V):
     fig.set_tight_layout(True)
 
 def makeplots(ec,savefig=False):
+    from matplotlib.pylab import gcf
     dfA = ec.dfA
     kAs = ec.kAs
 
@@ -21,7 +21,6 @@ import os
 import sys
 import tarfile
 import glob
-from astropy.io import fits
 import sqlite3
 import pandas as pd
 
@@ -63,6 +62,7 @@ def qload(file,allCol=False):
     t    : atpy table
 
     """
+    from astropy.io import fits
     hdu = fits.open(file)
     t = atpy.Table(file,type='fits')  
     if allCol is False:
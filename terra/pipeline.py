@@ -4,12 +4,12 @@ Defines the components of the TERRA pipeline.
 """
 
 import copy
+import multiprocessing
 import os
 
 import numpy as np
 from numpy import ma
 import pandas as pd
-from lmfit import minimize, fit_report
 
 from utils.hdfstore import HDFStore
 import prepro
@@ -73,6 +73,45 @@ def read_hdf(hdffile, group):
     pipe.read_hdf(hdffile, group)
     return pipe
 
+def read_lightcurve(path_phot, fluxfield='f', fluxmask='fmask'):
+    """Read a k2phot light curve into the format Pipeline expects
+
+    Args:
+        path_phot (str): fits file with the photometry
+        fluxfield (Optional[str]): column to use as the flux
+        fluxmask (Optional[str]): column to use as the mask
+
+    Returns:
+        lc (pandas DataFrame): all the columns in the file plus t, f,
+            ferr, and fmask. Missing cadences are filled in with masked
+            rows, since the grid search needs evenly spaced data. ferr
+            is a placeholder, fit_transits replaces it with the scatter
+            out of transit.
+    """
+    from astropy.io import fits
+    # fits columns are big-endian, which pandas does not handle well
+    data = fits.getdata(path_phot)
+    lc = pd.DataFrame()
+    for name in data.dtype.names:
+        x = np.array(data[name])
+        lc[name] = x.astype(x.dtype.newbyteorder('='))
+
+    if 'cad' in lc.columns:
+        isbool = lc.dtypes==bool
+        cad = np.arange(lc['cad'].iloc[0], lc['cad'].iloc[-1] + 1)
+        t = np.interp(cad, lc['cad'], lc['t'])
+        lc = lc.set_index('cad').reindex(cad)
+        lc.index.name = 'cad'
+        lc = lc.reset_index()
+        lc['t'] = t
+        for name in isbool[isbool].index:
+            lc[name] = lc[name].fillna(True).astype(bool)
+
+    lc['f'] = np.array(lc[fluxfield], dtype=float)
+    lc['fmask'] = np.array(lc[fluxmask], dtype=bool) | np.isnan(lc['f'])
+    lc['ferr'] = np.std(lc['f'][~lc['fmask']])
+    return lc
+
 def preprocess(pipe):
     """Process light curve in the time domain
 
@@ -95,29 +134,86 @@ def preprocess(pipe):
     pipe.update_header('finished_preprocess',True)
     return
 
-def grid_search(pipe, P1=0.5, P2=None, periodogram_mode='max'):
+def grid_search(pipe, P1=None, P2=None, periodogram_mode=None, nseg=None,
+                partition=None, grid=None, h5file=None, group='',
+                resume=False, **kwargs):
     """Run the grid based search
 
     Args:
         P1 (Optional[float]): Minimum period to search over. Default is 0.5
         P2 (Optional[float]): Maximum period to search over. Default is half 
             the time baseline
-        **kwargs : passed to grid.periodogram
+        periodogram_mode (Optional[str]): see Grid.periodogram. Default
+            is 'max'
+        nseg (Optional[int]): Number of period segments. Default is 10
+        partition (Optional[str]): How to split the period range into 
+            segments. 'log' (default) or 'cost'. See 
+            tfind.periodogram_parameters
+        grid (Optional[tfind.Grid]): grid returned by a previous call on
+            the same light curve with ncand > 0, e.g. before masking
+            the transits of the last candidate in a multi-planet
+            search. Only the phases touched by newly masked cadences
+            are searched again (see Grid.periodogram_update). The
+            periods and mode are those of the previous search, so none
+            of the other search arguments may be given.
+        h5file (Optional[str]): If given, the periodogram of each
+            segment is written to group + '/grid/segments/seg<i>' in
+            this file as soon as it is done, so that a killed job can
+            pick up where it left off.
+        group (Optional[str]): base group of the pipeline in h5file
+        resume (Optional[bool]): If True, read the segments already in
+            h5file instead of searching them again. The segments must
+            come from a search with the same parameters.
+        **kwargs : passed to grid.periodogram, e.g. backend='process' and
+            nproc to spread the search over several cores, or ncand to
+            allow a later incremental search.
 
     Returns:
-        None
+        grid (tfind.Grid): pass to the next call to search incrementally
 
     """
-    if type(P2) is type(None):
-        P2 = 0.49 * pipe.lc.t.ptp() 
-
     t = np.array(pipe.lc.t)
     fm = pipe._get_fm() 
-    grid = tfind.Grid(t, fm)
-    pipe.update_header('dt',grid.dt,'Exposure time (days)')
-    tbase = pipe.lc.t.max() - pipe.lc.t.min()
-    pgram_params = tfind.periodogram_parameters(P1, P2 , tbase, nseg=10)
-    pgram = grid.periodogram(pgram_params, mode=periodogram_mode)
+    if grid is None:
+        if P1 is None:
+            P1 = 0.5
+        if P2 is None:
+            P2 = 0.49 * pipe.lc.t.ptp() 
+        if periodogram_mode is None:
+            periodogram_mode = 'max'
+        if nseg is None:
+            nseg = 10
+        if partition is None:
+            partition = 'log'
+
+        grid = tfind.Grid(t, fm)
+        pipe.update_header('dt',grid.dt,'Exposure time (days)')
+        tbase = pipe.lc.t.max() - pipe.lc.t.min()
+        pgram_params = tfind.periodogram_parameters(
+            P1, P2 , tbase, nseg=nseg, partition=partition
+        )
+        if h5file is None:
+            pgram = grid.periodogram(
+                pgram_params, mode=periodogram_mode, **kwargs
+            )
+        else:
+            pgram = _grid_search_segments(
+                grid, pgram_params, periodogram_mode, h5file, group, 
+                resume, **kwargs
+            )
+    else:
+        search_args = [P1, P2, periodogram_mode, nseg, partition, h5file]
+        assert search_args.count(None)==len(search_args), \
+            "P1, P2, periodogram_mode, nseg, partition, and h5file are " \
+            "set by the previous search when grid is given"
+        assert not resume and len(kwargs)==0, \
+            "resume and periodogram arguments cannot be used with grid"
+
+        # Keep the median of the previous search, otherwise every
+        # cadence changes and the whole grid is searched again.
+        fm -= ma.median(fm - grid.fm)
+        pgram = grid.periodogram_update(fm)
+
     pgram = pgram.query('P > 0') # cut out candences that failed
 
     if len(pgram) > pipe.pgram_nbins:
@@ -138,12 +234,103 @@ def grid_search(pipe, P1=0.5, P2=None, periodogram_mode='max'):
     pipe.update_header(
         'grid_tdur', row.tdur, "Periodogram peak transit duration"
     )
+    pipe.update_header(
+        'grid_nbytes_alloc', grid.alloc_stats['nbytes_alloc'],
+        "Bytes allocated by the grid search workspace"
+    )
     pipe.update_table('pgram',pgram,'periodogram')
     pipe.update_header('finished_grid_search',True)
     print row
-    return None
+    return grid
 
-def fit_transits(pipe):
+def _grid_search_segments(grid, pgram_params, mode, h5file, group, resume,
+                          **kwargs):
+    """Run the grid search one segment at a time, with checkpoints
+
+    Each segment is searched with grid.periodogram and written to
+    h5file before the next one starts. The segment boundaries are
+    stored in group + '/grid/segments/params' and checked on resume.
+
+    Returns:
+        pgram (pandas DataFrame): periodograms of all the segments
+    """
+    assert kwargs.get('ncand', 0)==0, \
+        "checkpoints are not supported with ncand > 0"
+
+    segments = group + '/grid/segments'
+    params = pd.DataFrame(pgram_params)[['P1','P2']]
+    params['mode'] = mode
+
+    keys = []
+    if resume and os.path.exists(h5file):
+        with pd.HDFStore(h5file, 'r') as store:
+            keys = store.keys()
+
+    done = resume and (segments + '/params') in keys
+    if done:
+        params_done = pd.read_hdf(h5file, segments + '/params')
+        assert params_done.equals(params), \
+            "{} holds segments from a different search".format(h5file)
+    else:
+        params.to_hdf(h5file, segments + '/params')
+
+    alloc = dict(nalloc=0, nbytes_alloc=0)
+    pgram = []
+    for i, par in enumerate(pgram_params):
+        key = segments + '/seg{:02d}'.format(i)
+        if done and key in keys:
+            print "reading segment {} from {}".format(i, h5file)
+            pgram_seg = pd.read_hdf(h5file, key)
+        else:
+            pgram_seg = grid.periodogram([par], mode=mode, **kwargs)
+            pgram_seg.to_hdf(h5file, key)
+            for k in alloc:
+                alloc[k] += grid.alloc_stats[k]
+        pgram.append(pgram_seg)
+
+    if grid.alloc_stats is None:
+        grid.alloc_stats = grid.workspace.stats()
+    grid.alloc_stats = dict(grid.alloc_stats, **alloc)
+    pgram = pd.concat(pgram, ignore_index=True)
+    grid.pgram = pgram
+    return pgram
+
+def test_grid_search_segments():
+    """A resumed checkpointed search gives the uninterrupted periodogram
+
+    The checkpoints of a finished search are cut back to the first
+    segment, as if the job had been killed, and the search is resumed.
+    Once every segment is checkpointed, resuming must not search at
+    all, so it is done with a grid of zero flux.
+    """
+    import tempfile
+    import shutil
+    t, fm, intransit = tfind._test_transit(ncad=2000, P=3.1)
+    tbase = np.ptp(t)
+    pgram_params = tfind.periodogram_parameters(2, 4, tbase, nseg=3)
+    ref = tfind.Grid(t, fm).periodogram(pgram_params, mode='max')
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        h5file = os.path.join(tempdir, 'grid.h5')
+        pgram = _grid_search_segments(
+            tfind.Grid(t, fm), pgram_params, 'max', h5file, '', False
+        )
+        assert pgram.equals(ref)
+        with pd.HDFStore(h5file) as store:
+            store.remove('/grid/segments/seg01')
+            store.remove('/grid/segments/seg02')
+
+        for grid in [tfind.Grid(t, fm), tfind.Grid(t, fm * 0)]:
+            pgram = _grid_search_segments(
+                grid, pgram_params, 'max', h5file, '', True
+            )
+            assert pgram.equals(ref)
+    finally:
+        shutil.rmtree(tempdir)
+
+def fit_transits(pipe, nproc=1, method='nelder', fit_window=None, 
+                 phase_bin=None):
     """Fit transits
 
     Performs the following tasks:
@@ -154,6 +341,26 @@ def fit_transits(pipe):
 
     Args:
         pipe (Pipeline object): pipeline objec
+        nproc (Optional[int]): number of processes for the single
+            transit fits (3. and 4.). Default is 1, no pool. Must be 1
+            inside a daemonic worker, e.g. under `terra batch`.
+        method (Optional[str]): minimizer for the global fit (2.).
+            'nelder' (default) or 'leastsq', Levenberg-Marquardt with
+            the Jacobian from TransitModel.jacobian. leastsq needs far
+            fewer model evaluations and gives uncertainties.
+        fit_window (Optional[float]): if set, the global fit only
+            evaluates the model within fit_window * tdur of the
+            predicted mid-transits. The model is constant (zero)
+            outside, so those points are added to chi2 as a constant.
+            The window is widened to cover the transit for any
+            parameters within the fit bounds, about 3.5 tdur with the
+            default bounds.
+        phase_bin (Optional[float]): if set, the global fit is done on
+            the light curve phase-folded on the grid search period and
+            binned to phase_bin (days), with the period held fixed.
+            Meant for short period, high SNR candidates with many
+            transits. fit_rchisq is still computed on the unbinned
+            light curve.
 
     Notes:
         Tables updated:
@@ -168,6 +375,7 @@ def fit_transits(pipe):
         None
 
     """
+    from lmfit import minimize, fit_report
     batman_kw = dict(supersample_factor=4, exp_time=1.0/48.0)
     label_transit_kw = dict(cpad=0, cfrac=2)
     local_detrending_kw = dict(
@@ -209,14 +417,54 @@ def fit_transits(pipe):
 
     tm_initial = copy.deepcopy(tm)
 
-    method = 'nelder'
+    fit_kw = {}
+    if method=='leastsq':
+        fit_kw = dict(Dfun=tm.jacobian, col_deriv=False)
+    else:
+        assert method=='nelder', "method must be nelder or leastsq"
+
+    # Data the model is evaluated on during the global fit
+    tfit, ffit, ferrfit = t, f, ferr
+    chisq_out, nout = 0.0, 0
+    if fit_window is not None:
+        tfit, ffit, ferrfit, chisq_out, nout = _fit_window(
+            tm, t, f, ferr, fit_window * tdur
+        )
+    if phase_bin is not None:
+        tm.lm_params['per'].vary = False
+        tfit, ffit, ferrfit = _bin_phase(tm, tfit, ffit, ferrfit, phase_bin)
+
     print 
     print "Fitting constant ephem model using method={}".format(method)
+    print "{} of {} points, {} out of window".format(len(tfit), len(t), nout)
     print "Initial parameters"
     print "------------------"
     tm.lm_params.pretty_print() 
 
-    out = minimize(tm.residual, tm.lm_params, args=(t, f, ferr), method=method)
+    out = minimize(
+        tm.residual, tm.lm_params, args=(tfit, ffit, ferrfit), method=method,
+        **fit_kw
+    )
+
+    # Add back the points outside the window. lmfit scales the
+    # uncertainties by the reduced chi2, so rescale them as well. The
+    # chi2 of binned points is not comparable to that of the unbinned
+    # ones, so with phase_bin the best fit model is evaluated on the
+    # unbinned light curve instead and the binned uncertainties are
+    # kept. Fixed parameters (per with phase_bin) have no uncertainty.
+    if phase_bin is None:
+        rchisq = (out.chisqr + chisq_out) / (out.ndata + nout - out.nvarys)
+        stderr_scale = np.sqrt(rchisq / out.redchi)
+    else:
+        resid = tm.residual(out.params, t, f, ferr)
+        rchisq = np.sum(resid**2) / (len(t) - out.nvarys)
+        stderr_scale = 1.0
+
+    for par in out.params.values():
+        if not par.vary:
+            par.stderr = None
+        elif par.stderr is not None:
+            par.stderr *= stderr_scale
     print 
     print "Best fit parameters"
     print "-------------------"
@@ -236,7 +484,7 @@ def fit_transits(pipe):
     pipe.update_header('fit_utdur', par['tdur'].stderr, "Best fit duration")
     pipe.update_header('fit_b', par['b'].value, "Best fit impact parameter")
     pipe.update_header('fit_ub', par['b'].stderr, "Uncertainty")
-    pipe.update_header('fit_rchisq', out.redchi, "Reduced Chi-squared")
+    pipe.update_header('fit_rchisq', rchisq, "Reduced Chi-squared")
 
     tm_global = copy.deepcopy(tm)
     tm_global.lm_params = out.params
@@ -249,34 +497,24 @@ def fit_transits(pipe):
     lcfit['f'] = tm_global.model(tm_global.lm_params, np.array(lcfit.t_shift))
     lcfit['f_initial'] = tm.model(tm_initial.lm_params, np.array(lcfit.t_shift))
 
-    # Fit inidvidual transits
-    transits = []
-    for transit_id, idx in lcdt.groupby('transit_id').groups.iteritems():
-        transit = dict(transit_id=transit_id)
-        lcdt_single = lcdt.ix[idx]
+    # Fit inidvidual transits. The fits are independent, so they can
+    # be farmed out to a pool. Jobs only carry the data of one transit
+    # and a dict describing the global model.
+    tm_dict = tm_global.to_dict()
+    jobs = []
+    for transit_id, lcdt_single in lcdt.groupby('transit_id'):
         t = np.array(lcdt_single.t_shift) 
         f = np.array(lcdt_single.f)
         ferr = np.array(lcdt_single.ferr)
-        def _get_tm():
-            tm = copy.deepcopy(tm_global)
-            for key in 'per t0 rp tdur b'.split():
-                tm.lm_params[key].vary = False
-            return tm
-
-        # Fit the transit times, holding other parameters constant
-        tm = _get_tm()
-        tm.lm_params['t0'].vary = True
-        out = minimize(tm.residual, tm.lm_params, args=(t,f,ferr) )
-        transit['t0'] = out.params['t0'].value
-        transit['ut0'] = out.params['t0'].stderr
-
-        # Fit the transit depths, holding other parameters constant
-        tm = _get_tm()
-        tm.lm_params['rp'].vary = True
-        out = minimize(tm.residual, tm.lm_params, args=(t,f,ferr) )
-        transit['rp'] = out.params['rp'].value
-        transit['urp'] = out.params['rp'].stderr
-        transits+=[transit]
+        jobs.append((transit_id, tm_dict, t, f, ferr))
+
+    if nproc==1:
+        transits = map(_fit_single_transit, jobs)
+    else:
+        pool = multiprocessing.Pool(nproc)
+        transits = pool.map(_fit_single_transit, jobs)
+        pool.close()
+        pool.join()
 
     # Constant ephemeris, then adjust for observed O - C.
     fit_P = pipe.fit_P
@@ -300,6 +538,166 @@ def fit_transits(pipe):
     )
     return None
 
+def _fit_window(tm, t, f, ferr, half_width):
+    """Split off the points where the transit model is constant
+
+    Args:
+        tm (tval.TransitModel): model with the fit bounds set
+        t, f, ferr (array): data
+        half_width (float): keep points within half_width (days) of
+            the mid-transits predicted by tm. Widened if a transit edge
+            can get farther than this for parameters within the bounds.
+
+    Returns:
+        t, f, ferr (array): points in the window
+        chisq_out (float): chi2 of the points outside, where the model
+            is zero
+        nout (int): number of points outside
+    """
+    assert tm.subtract_one, "model must be zero out of transit"
+    par = tm.lm_params
+    P = par['per'].value
+    t0 = par['t0'].value
+    n = np.round((t - t0) / P)
+
+    # Farthest a transit edge can get from its predicted mid-transit
+    # for parameters within the bounds
+    max_offset = (
+        0.5 * par['tdur'].max 
+        + max(par['t0'].max - t0, t0 - par['t0'].min)
+        + max(par['per'].max - P, P - par['per'].min) * np.abs(n).max()
+    )
+    half_width = max(half_width, max_offset)
+
+    win = np.abs(t - t0 - n * P) < half_width
+    chisq_out = np.sum((f[~win] / ferr[~win])**2)
+    return t[win], f[win], ferr[win], chisq_out, np.sum(~win)
+
+def _bin_phase(tm, t, f, ferr, width):
+    """Phase-fold on the ephemeris of tm and bin
+
+    Folded times are kept next to the epoch t0, so the binned light
+    curve can be fit with the same parameters (period held fixed).
+
+    Returns:
+        tb, fb, ferrb (array): mean time, mean flux, and its
+            uncertainty in every non-empty bin
+    """
+    P = tm.lm_params['per'].value
+    t0 = tm.lm_params['t0'].value
+    tfold = t - P * np.round((t - t0) / P)
+    ibin = np.floor((tfold - tfold.min()) / width).astype(int)
+    count = np.bincount(ibin)
+    b = count > 0
+    count = count[b]
+    tb = np.bincount(ibin, tfold)[b] / count
+    fb = np.bincount(ibin, f)[b] / count
+    ferrb = np.sqrt(np.bincount(ibin, ferr**2)[b]) / count
+    return tb, fb, ferrb
+
+def _fit_single_transit(job):
+    """Fit t0 and rp of a single transit, holding the rest fixed
+
+    Args:
+        job (tuple): transit_id, model dict (TransitModel.to_dict), t,
+            f, ferr
+
+    Returns:
+        transit (dict): transit_id, t0, ut0, rp, urp
+    """
+    from lmfit import minimize
+    transit_id, tm_dict, t, f, ferr = job
+    transit = dict(transit_id=transit_id)
+    def _get_tm():
+        tm = tval.transit_model_from_dict(tm_dict)
+        for key in 'per t0 rp tdur b'.split():
+            tm.lm_params[key].vary = False
+        return tm
+
+    # Fit the transit times, holding other parameters constant
+    tm = _get_tm()
+    tm.lm_params['t0'].vary = True
+    out = minimize(tm.residual, tm.lm_params, args=(t,f,ferr) )
+    transit['t0'] = out.params['t0'].value
+    transit['ut0'] = out.params['t0'].stderr
+
+    # Fit the transit depths, holding other parameters constant
+    tm = _get_tm()
+    tm.lm_params['rp'].vary = True
+    out = minimize(tm.residual, tm.lm_params, args=(t,f,ferr) )
+    transit['rp'] = out.params['rp'].value
+    transit['urp'] = out.params['rp'].stderr
+    return transit
+
+def mask_transits(pipe, cutfac=1):
+    """Mask out the transits of the last fit
+
+    Args:
+        pipe (Pipeline object): must have been through fit_transits
+        cutfac (Optional[float]): padding that is also cut on either
+            side of each transit, in units of fit_tdur
+
+    Returns:
+        None
+    """
+    lc = tval.add_phasefold(pipe.lc, pipe.lc.t, pipe.fit_P, pipe.fit_t0)
+    intransit = np.abs(lc.t_phasefold) < (0.5 + cutfac) * pipe.fit_tdur
+    lc['fmask'] = lc['fmask'] | intransit
+    pipe.update_table('lc', lc)
+    print "mask_transits: masked {} measurements".format(intransit.sum())
+
+def search_planets(pipe, P1=None, P2=None, ncand=8, max_planets=5,
+                   s2n_threshold=8, cutfac=1, **kwargs):
+    """Search for several planets, one at a time
+
+    Runs grid_search and fit_transits, masks the transits of the
+    candidate, and searches again until the periodogram peak falls
+    below s2n_threshold or max_planets candidates have been fit. The
+    searches after the first only fold again the phases that contain
+    newly masked cadences (see Grid.periodogram_update).
+
+    Iterate over it; pipe holds the current candidate at each step:
+
+        >>> for nplanet in pipeline.search_planets(pipe):
+        ...     pipe.to_hdf('{}.{:02d}.h5'.format(starname, nplanet), '/')
+
+    Args:
+        pipe (Pipeline object): preprocessed pipeline
+        P1, P2 (Optional[float]): period range, see grid_search
+        ncand (Optional[int]): candidates kept per trial period and
+            duration for the incremental searches, see Grid.periodogram.
+            Not used if max_planets is 1.
+        max_planets (Optional[int]): maximum number of candidates
+        s2n_threshold (Optional[float]): stop after a candidate below
+            this periodogram s2n. That candidate is still fit.
+        cutfac (Optional[float]): see mask_transits
+        **kwargs : passed to the first grid_search, e.g. backend and
+            nproc. Checkpoints (h5file and resume) keep no candidates,
+            so they require max_planets=1.
+
+    Yields:
+        nplanet (int): number of the current candidate, starting at 1
+    """
+    # Candidates are only needed if there is a second search
+    if max_planets < 2:
+        ncand = 0
+
+    grid = None
+    for nplanet in range(1, max_planets + 1):
+        if grid is None:
+            grid = grid_search(pipe, P1=P1, P2=P2, ncand=ncand, **kwargs)
+        else:
+            mask_transits(pipe, cutfac=cutfac)
+            grid = grid_search(pipe, grid=grid)
+
+        fit_transits(pipe)
+        yield nplanet
+        if pipe.grid_s2n < s2n_threshold:
+            print "search_planets: s2n = {:.1f} < {:.1f}".format(
+                pipe.grid_s2n, s2n_threshold
+            )
+            return
+
 def secondary_eclipse_search(pipe):
     """Search for secondary eclipse
     """
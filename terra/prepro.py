@@ -14,7 +14,6 @@ from matplotlib import mlab
 from matplotlib.mlab import csv2rec,rec_append_fields
 import h5py
 import pandas as pd
-from astropy.io import fits
 
 import cotrend
 import config
@@ -53,6 +52,7 @@ def raw(h5,files,fields=[]):
 
     fields - list of fields to keep. Use a subset for smaller file size.
     """
+    from astropy.io import fits
     raw  = h5.create_group('/raw')
     hduL = []
     kicL = []
@@ -4,19 +4,22 @@ Transit finder.
 Evaluate a figure of merit at each point in P,epoch,tdur space.
 """
 import itertools
+import collections
+import hashlib
+import os
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
 
-import scipy
-from scipy import ndimage as nd
 import numpy as np
 from numpy import ma
 import pandas as pd
-import h5py
 
 from FFA import FFA_cext as FFA
+from FFA import fold
 import config
-from utils import h5plus
 from keptoy import P2a,a2tdur
-from utils.h5plus import h5F
 
 # dtype of the record array returned from ep()
 epnames = ['mean','count','t0cad','Pcad']
@@ -35,9 +38,23 @@ class Grid(object):
         t (numpy array) : Time of observations. Must be evenly spaced.
         fm (masked array) : Flux values. Must be median normalized and
             subtract off unity.
-
+        precision (Optional[str]) : Precision of the folding kernels.
+            - double : float64 throughout (default).
+            - single : the single event statistic is handed to the
+              folding kernels as float32, halving the memory traffic in
+              the inner loops. Column sums are still accumulated in
+              float64 (pgram_max, bls, fm) and the FFA is float32 in either
+              mode, so peak s2n, P, and t0 agree with double precision
+              to ~1e-6 in relative terms. See bench.precision.
+
+    Attributes:
+        workspace (Workspace) : work buffers shared by the folding
+            kernels across segments and periodogram calls.
+        alloc_stats (dict) : workspace allocations made by the last
+            call to periodogram (nalloc, nbytes_alloc, nbytes),
+            including those made by the process pool workers.
     """
-    def __init__(self, t, fm):
+    def __init__(self, t, fm, precision='double'):
         assert isinstance(t, np.ndarray), "t must be plain numpy array"
         assert isinstance(fm, ma.core.MaskedArray), "fm must be masked array"
 
@@ -45,11 +62,23 @@ class Grid(object):
         meddt = np.median(dt)
         assert np.allclose(dt, meddt, rtol=1e-3), "t must be evenly spaced"
 
+        assert precision in ['double','single'], \
+            "precision must be double or single"
+
         self.dt = meddt
         self.t = t 
         self.fm = fm
-
-    def periodogram(self, param_list, mode='std'):
+        self.precision = precision
+        self.dtype = dict(double=np.float64, single=np.float32)[precision]
+        self.plan_cache = FoldPlanCache(fm.size)
+        self.workspace = Workspace()
+        self.alloc_stats = None
+        self._coarse_grids = {}
+        self._pgram_states = None
+
+    def periodogram(self, param_list, mode='std', backend='serial', 
+                    nproc=None, nunits=None, adaptive=False, ncand=0,
+                    **kwargs):
         """Run the transit finding periodogram
         
         Arguments: 
@@ -65,6 +94,28 @@ class Grid(object):
                 - ffa : SES then fold.
                 - fm : foreman mackey algo.
 
+            backend (Optional[str]) : How to execute the segments.
+                - serial : one after the other in this process (default).
+                - thread : thread pool. Only helps where the kernels 
+                  release the GIL (e.g. fold.pgram_max_block).
+                - process : process pool. The light curve is placed in
+                  shared memory once and inherited by the workers.
+            nproc (Optional[int]) : Number of workers. Defaults to the 
+                number of cores.
+            nunits (Optional[int]) : Number of work units. For the parallel
+                backends, segments are split into blocks of periods with
+                roughly equal estimated cost (see `segment_cost`). Defaults
+                to 4 * nproc.
+            adaptive (Optional[bool]) : If True, run the coarse-to-fine
+                search of `periodogram_adaptive`. Remaining keyword
+                arguments (fbin, ntop, s2n_refine) are passed to it.
+                Cannot be combined with ncand.
+            ncand (Optional[int]) : max mode only. If > 0, keep the
+                ncand best columns of every trial period and duration
+                so that `periodogram_update` can redo the search after
+                more cadences are masked. Costs ~(20 * ncand + 8) bytes
+                per trial period and duration.
+
         Returns:
             pgram (pandas DataFrame) : Transit search periodogram. Contains the
                 following fields:
@@ -76,36 +127,115 @@ class Grid(object):
                 - s2n : signal to noise ratio.
         """
 
-        param_list = pd.DataFrame(param_list)
-        columns = list(param_list.columns)
-        if columns.count('Pcad1')==0:
-            param_list['Pcad1'] = param_list['P1'] / self.dt
-            param_list['Pcad2'] = param_list['P2'] / self.dt
-        if columns.count('P1')==0:
-            param_list['P1'] = param_list['Pcad1'] * self.dt
-            param_list['P2'] = param_list['Pcad2'] * self.dt
+        if adaptive:
+            # The adaptive periodogram is not a full resolution search,
+            # so there is nothing for periodogram_update to start from
+            assert ncand==0, "ncand is not supported with adaptive=True"
+            return self.periodogram_adaptive(
+                param_list, mode=mode, backend=backend, nproc=nproc, 
+                nunits=nunits, **kwargs
+            )
+        assert len(kwargs)==0, "unexpected arguments {}".format(kwargs.keys())
+
+        assert ncand==0 or mode=='max', "ncand requires mode max"
 
+        param_list = self._param_list(param_list)
         names = 'P1 P2 twdG'.split()
-        print param_list[names]
+        print pd.DataFrame(param_list)[names]
+
+        self.workspace.reset_stats()
+        alloc_stats = None
+        if backend=='serial':
+            pgram = [self._pgram(mode, par, ncand) for par in param_list]
+        else:
+            if nproc is None:
+                nproc = multiprocessing.cpu_count()
+            if nunits is None:
+                nunits = 4 * nproc
+
+            # Work units come back in the same order they were sent,
+            # so the merged periodogram is the same as the serial one
+            units = split_work(param_list, nunits, self.fm.size, self.dt)
+            args = [(mode, par, ncand) for par in units]
+            if backend=='thread':
+                pool = ThreadPool(nproc)
+                pgram = pool.map(self._pgram_star, args, chunksize=1)
+            elif backend=='process':
+                initargs = _shared_lightcurve(self.t, self.fm)
+                initargs += (self.precision,)
+                pool = multiprocessing.Pool(nproc, _init_worker, initargs)
+                res = pool.map(_worker_pgram, args, chunksize=1)
+
+                # The workers allocate from their own workspaces
+                pgram = [r[0] for r in res]
+                alloc_stats = _merge_worker_stats([r[1] for r in res])
+            else:
+                assert False, "backend must be serial, thread, or process"
+            pool.close()
+            pool.join()
+
+        self._pgram_states = None
+        if ncand > 0:
+            pgram, self._pgram_states = zip(*pgram)
+        return self._finish_periodogram(pgram, mode, alloc_stats)
+
+    def periodogram_update(self, fm, max_changed=0.1):
+        """Redo the last periodogram for a new flux array
+
+        Meant for the multi-planet search, where the transits of the
+        previous candidate are masked out and the search is repeated.
+        Only the phases that contain a changed cadence are folded
+        again (see pgram_max_update). The result is the same as
+        running periodogram on the new flux.
+
+        The last call to periodogram must have used mode='max' and
+        ncand > 0. The Grid is switched to the new flux.
+
+        Args:
+            fm (masked array) : new flux, same cadences as the old one.
+                Usually the old flux with more points masked.
+            max_changed (Optional[float]) : if more than this fraction
+                of cadences changed, run the full periodogram instead.
 
-        param_list = [dict(row) for i,row in param_list.iterrows()]
+        Returns:
+            pgram (pandas DataFrame) : see periodogram
+        """
+        assert self._pgram_states is not None, \
+            "run periodogram with mode='max' and ncand > 0 first"
+        assert fm.size==self.fm.size, "fm must have the same cadences"
+
+        mask0 = ma.getmaskarray(self.fm)
+        mask1 = ma.getmaskarray(fm)
+        changed = (mask0!=mask1) | (
+            ~mask1 & (ma.getdata(self.fm)!=ma.getdata(fm))
+        )
+        self.fm = fm
+        self._coarse_grids = {}
+
+        states = self._pgram_states
+        if changed.mean() > max_changed:
+            param_list = [state['par'] for state in states]
+            ncand = states[0]['cand_col'].shape[-1]
+            return self.periodogram(param_list, mode='max', ncand=ncand)
+
+        self.workspace.reset_stats()
+        pgram = [
+            pgram_max_update(self.t, fm, changed, state, dtype=self.dtype)
+            for state in states
+        ]
+        return self._finish_periodogram(pgram, 'max')
 
-        if mode=='max':
-            pgram = map(self._pgram_max,param_list)
-            pgram = np.hstack(pgram)
-            pgram = pd.DataFrame(pgram)
-        if mode=='ffa':
-            pgram = map(self._pgram_ffa,param_list)
-            pgram = pd.DataFrame(np.hstack(pgram))
+    def _finish_periodogram(self, pgram, mode, alloc_stats=None):
+        """Merge the segment periodograms into a DataFrame
+
+        alloc_stats are the workspace stats of the search. If None,
+        the stats of this Grid's workspace are used.
+        """
+        pgram = np.hstack(pgram)
+        pgram = pd.DataFrame(pgram)
         if mode=='bls':
-            pgram = map(self._pgram_bls,param_list)
-            pgram = np.hstack(pgram)
-            pgram = pd.DataFrame(pgram)
             pgram['t0'] = self.t[0] + (pgram['col']+pgram['twd']/2)*config.lc
         if mode=='fm':
-            pgram = map(self._pgram_fm,param_list)
-            pgram = np.hstack(pgram)
-            pgram = pd.DataFrame(pgram)
             pgram['t0'] = self.t[0] + (pgram['col']+pgram['twd']/2)*config.lc
             pgram['s2n'] = pgram['depth_2d'] * np.sqrt(pgram['depth_ivar_2d'])
             pgram['mean'] = pgram['depth_2d']
@@ -114,25 +244,341 @@ class Grid(object):
         pgram['P'] = self.dt * pgram['Pcad']
         pgram['tdur'] = self.dt * pgram['twd']
         self.pgram = pgram
+        if alloc_stats is None:
+            alloc_stats = self.workspace.stats()
+        self.alloc_stats = alloc_stats
+        return pgram
+
+    def periodogram_adaptive(self, param_list, mode='max', fbin=0.5, 
+                             ntop=10, s2n_refine=7.0, **kwargs):
+        """Coarse-to-fine transit search periodogram
+
+        First search a binned copy of the light curve, then recompute
+        the periodogram at full resolution around the ntop highest
+        coarse peaks and wherever the coarse s2n exceeds s2n_refine.
+
+        Binning by nbin cadences makes the fractional period step of
+        the search nbin times coarser (see pgram_max) and each fold
+        nbin times cheaper. Each segment is binned by nbin = max(1,
+        int(fbin * min(twdG))), so that, as in `perGrid`, transits at
+        neighboring coarse periods drift apart by only ~fbin of the
+        shortest trial duration over the light curve. Segments with
+        nbin = 1 are searched at full resolution directly.
+
+        Refined periods are the same trial periods as the exhaustive
+        search, so whenever the true peak is among the refined peaks,
+        the peak of the adaptive periodogram matches the exhaustive
+        one. See test_periodogram_adaptive.
+
+        Args:
+            param_list (list) : See periodogram
+            mode (str) : See periodogram
+            fbin (Optional[float]) : bin size as a fraction of the 
+                shortest trial duration of each segment.
+            ntop (Optional[int]) : number of coarse peaks to refine.
+            s2n_refine (Optional[float]) : refine all coarse periods with
+                s2n above this value.
+            **kwargs : passed to periodogram, e.g. backend.
+
+        Returns:
+            pgram (pandas DataFrame) : Same fields as periodogram. Full
+                resolution in the refined regions and coarse elsewhere.
+                The extra refined field flags full resolution rows.
+        """
+        param_list = self._param_list(param_list)
+        ncad = self.fm.size
+
+        # Coarse pass. Segments that share a bin size share a search.
+        nbinL = [max(1, int(fbin * min(par['twdG']))) for par in param_list]
+        coarse = []
+        alloc_stats = []
+        for nbin in sorted(set(nbinL)):
+            if nbin==1:
+                continue
+            grid = self._coarse_grid(nbin)
+            params = [
+                _coarse_par(par, nbin) 
+                for par, _nbin in zip(param_list, nbinL) if _nbin==nbin
+            ]
+            pgram = grid.periodogram(params, mode=mode, **kwargs)
+            alloc_stats.append(grid.alloc_stats)
+            pgram = pgram[pgram['P'] > 0].copy()
+
+            # Convert back to full resolution cadences. Column indecies
+            # in t0 are in bins of nbin cadences
+            pgram['Pcad'] = pgram['P'] / self.dt
+            pgram['twd'] = pgram['tdur'] / self.dt
+            pgram['t0'] = self.t[0] + (pgram['t0'] - self.t[0]) * nbin
+            pgram['nbin'] = nbin
+            coarse.append(pgram)
+
+        # Integer periods (cadences) to search at full resolution,
+        # covering 2 coarse steps on either side of each peak
+        refine = set()
+        if len(coarse) > 0:
+            coarse = pd.concat(coarse, ignore_index=True)
+            coarse = coarse.sort_values('s2n', ascending=False)
+            b = np.arange(len(coarse)) < ntop 
+            b |= (coarse['s2n'] > s2n_refine).values
+            for i, row in coarse[b].iterrows():
+                step = row['nbin'] * row['Pcad'] / ncad
+                Pcad1 = int(np.floor(row['Pcad'] - 2 * step))
+                Pcad2 = int(np.floor(row['Pcad'] + 2 * step))
+                refine.update(range(Pcad1, Pcad2 + 1))
+
+        fine_params = []
+        for par, nbin in zip(param_list, nbinL):
+            if nbin==1:
+                fine_params.append(par)
+                continue
+            PcadG = np.arange(par['Pcad1'], par['Pcad2']).astype(int)
+            PcadG = PcadG[[Pcad in refine for Pcad in PcadG]]
+            for run in np.split(PcadG, np.where(np.diff(PcadG) > 1)[0] + 1):
+                if run.size==0:
+                    continue
+                unit = dict(par)
+                unit['Pcad1'] = run[0]
+                unit['Pcad2'] = run[-1] + 0.5
+                unit['P1'] = unit['Pcad1'] * self.dt
+                unit['P2'] = unit['Pcad2'] * self.dt
+                fine_params.append(unit)
+
+        pgram = []
+        if len(fine_params) > 0:
+            fine = self.periodogram(fine_params, mode=mode, **kwargs)
+            alloc_stats.append(self.alloc_stats)
+            fine['refined'] = True
+            pgram.append(fine)
+
+        # Replace the coarse periodogram in the refined regions
+        if len(coarse) > 0:
+            refined = np.floor(coarse['Pcad']).astype(int).isin(refine)
+            coarse = coarse[~refined.values].drop('nbin', axis=1)
+            coarse['refined'] = False
+            pgram.append(coarse)
+
+        pgram = pd.concat(pgram, ignore_index=True)
+        pgram = pgram.sort_values('P').reset_index(drop=True)
+        self.pgram = pgram
+        self.alloc_stats = dict(
+            [(k, sum([stats[k] for stats in alloc_stats])) 
+             for k in ['nalloc', 'nbytes_alloc', 'nbytes']]
+        )
         return pgram
 
+    def _coarse_grid(self, nbin):
+        """Grid for the light curve binned by nbin cadences"""
+        if nbin not in self._coarse_grids:
+            tb, fmb = bin_lightcurve(self.t, self.fm, nbin)
+            self._coarse_grids[nbin] = Grid(tb, fmb, precision=self.precision)
+        return self._coarse_grids[nbin]
+
+    def _param_list(self, param_list):
+        """Fill in P1, P2 or Pcad1, Pcad2 and return a list of dicts"""
+        param_list = pd.DataFrame(param_list)
+        columns = list(param_list.columns)
+        if columns.count('Pcad1')==0:
+            param_list['Pcad1'] = param_list['P1'] / self.dt
+            param_list['Pcad2'] = param_list['P2'] / self.dt
+        if columns.count('P1')==0:
+            param_list['P1'] = param_list['Pcad1'] * self.dt
+            param_list['P2'] = param_list['Pcad2'] * self.dt
+        return [dict(row) for i,row in param_list.iterrows()]
+
+    def _pgram(self, mode, par, ncand=0):
+        """Compute the periodogram for a single segment"""
+        if mode=='max':
+            return self._pgram_max(par, ncand)
+        if mode=='ffa':
+            return self._pgram_ffa(par)
+        if mode=='bls':
+            return self._pgram_bls(par)
+        if mode=='fm':
+            return self._pgram_fm(par)
+        assert False, "mode must be max, ffa, bls, or fm"
+
+    def _pgram_star(self, args):
+        return self._pgram(*args)
+
     def _pgram_ffa(self,par):
-        rtd = tdpep(self.t, self.fm, par)
+        rtd = tdpep(
+            self.t, self.fm, par, dtype=self.dtype, workspace=self.workspace
+        )
         r = tdmarg(rtd)
         return r
 
-    def _pgram_max(self,par):
-        pgram = pgram_max(self.t, self.fm, par)
+    def _pgram_max(self,par,ncand=0):
+        pgram = pgram_max(
+            self.t, self.fm, par, plan_cache=self.plan_cache, 
+            dtype=self.dtype, workspace=self.workspace, ncand=ncand
+        )
         return pgram
 
     def _pgram_bls(self,par):
-        pgram = bls(self.t, self.fm, par)
+        pgram = bls(
+            self.t, self.fm, par, plan_cache=self.plan_cache, 
+            dtype=self.dtype, workspace=self.workspace
+        )
         return pgram
 
     def _pgram_fm(self,par):
-        pgram = foreman_mackey(self.t, self.fm, par)
+        pgram = foreman_mackey(
+            self.t, self.fm, par, plan_cache=self.plan_cache, 
+            dtype=self.dtype, workspace=self.workspace
+        )
         return pgram
 
+def _coarse_par(par, nbin):
+    """Periodogram parameters for a light curve binned by nbin"""
+    twdG = np.round(np.array(par['twdG']) / float(nbin)).astype(int)
+    twdG = np.unique(np.maximum(twdG, 1))
+    return dict(
+        Pcad1=int(np.floor(par['Pcad1'] / nbin)),
+        Pcad2=int(np.ceil(par['Pcad2'] / nbin)),
+        twdG=list(twdG)
+    )
+
+def bin_lightcurve(t, fm, nbin):
+    """Bin a light curve by nbin cadences
+
+    Each bin is the mean of its unmasked points. Bins with fewer than
+    half of their points unmasked are masked. The partial bin at the
+    end is dropped.
+
+    Args:
+        t (numpy array) : evenly spaced times
+        fm (masked array) : flux
+        nbin (int) : number of cadences per bin
+
+    Returns:
+        tb (numpy array) : time of the first cadence of each bin 
+        fmb (masked array) : binned flux, fill_value = 0
+    """
+    nb = fm.size // nbin
+    n = nb * nbin
+    good = (~ma.getmaskarray(fm[:n])).reshape(nb, nbin)
+    f = ma.getdata(fm[:n]).reshape(nb, nbin)
+    c = good.sum(axis=1)
+    s = np.where(good, f, 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fb = s / c
+    mask = c < nbin / 2.0
+    fb[mask] = 0
+    fmb = ma.masked_array(fb, mask, fill_value=0)
+    tb = t[0] + nbin * (t[1] - t[0]) * np.arange(nb)
+    return tb, fmb
+
+# Grid used by the process pool workers. Set by _init_worker
+_worker_grid = None
+
+def _shared_lightcurve(t, fm):
+    """Copy the light curve into shared memory
+
+    Returns the arguments to _init_worker. The buffers are inherited
+    by the forked workers, so the light curve is not pickled and sent
+    with every work unit.
+    """
+    n = fm.size
+    t_shared = RawArray('d', n)
+    data_shared = RawArray('d', n)
+    mask_shared = RawArray('b', n)
+    np.frombuffer(t_shared, dtype=float)[:] = t
+    np.frombuffer(data_shared, dtype=float)[:] = fm.data
+    np.frombuffer(mask_shared, dtype=np.int8)[:] = ma.getmaskarray(fm)
+    return (t_shared, data_shared, mask_shared, fm.fill_value)
+
+def _init_worker(t_shared, data_shared, mask_shared, fill_value, precision):
+    global _worker_grid
+    t = np.frombuffer(t_shared, dtype=float)
+    data = np.frombuffer(data_shared, dtype=float)
+    mask = np.frombuffer(mask_shared, dtype=np.int8).view(bool)
+    fm = ma.masked_array(data, mask, fill_value=fill_value)
+    _worker_grid = Grid(t, fm, precision=precision)
+
+def _worker_pgram(args):
+    """Run one work unit. Returns the result and the workspace stats"""
+    _worker_grid.workspace.reset_stats()
+    res = _worker_grid._pgram(*args)
+    stats = dict(_worker_grid.workspace.stats(), pid=os.getpid())
+    return res, stats
+
+def _merge_worker_stats(stats):
+    """Add up the workspace stats of the work units
+
+    Allocations are summed over the units. nbytes is held by each
+    worker across its units, so it is summed over the workers.
+    """
+    nbytes = {}
+    for s in stats:
+        nbytes[s['pid']] = max(nbytes.get(s['pid'], 0), s['nbytes'])
+    return dict(
+        nalloc=sum([s['nalloc'] for s in stats]),
+        nbytes_alloc=sum([s['nbytes_alloc'] for s in stats]),
+        nbytes=sum(nbytes.values())
+    )
+
+def segment_cost(par, ncad):
+    """Estimated cost of computing the periodogram over one segment
+
+    Every trial period touches each cadence once per trial duration,
+    and there are ~ncad / Pcad fractional trial periods between Pcad
+    and Pcad + 1 (see pgram_max).
+
+    Args:
+        par (dict) : periodogram parameters, with Pcad1, Pcad2, and twdG
+        ncad (int) : number of cadences in the light curve
+
+    Returns:
+        cost (array) : estimated cost of each integer period in 
+            np.arange(Pcad1, Pcad2). Units of cadence operations.
+    """
+    PcadG = np.arange(par['Pcad1'], par['Pcad2'])
+    nfrac = np.ceil(1.0 * ncad / PcadG)
+    return nfrac * ncad * len(par['twdG'])
+
+def split_work(param_list, nunits, ncad, dt):
+    """Split periodogram segments into work units of similar cost
+
+    Each segment is cut into contiguous blocks of integer periods. The
+    blocks are returned in order, so concatenating their periodograms
+    reproduces the periodogram of the full segment list.
+
+    Args:
+        param_list (list) : list of periodogram parameters
+        nunits (int) : target number of work units 
+        ncad (int) : number of cadences in the light curve
+        dt (float) : cadence spacing
+
+    Returns:
+        units (list) : list of periodogram parameters
+    """
+    costs = [segment_cost(par, ncad) for par in param_list]
+    total = np.sum([np.sum(cost) for cost in costs])
+    target = total / nunits
+
+    units = []
+    for par, cost in zip(param_list, costs):
+        PcadG = np.arange(par['Pcad1'], par['Pcad2'])
+        if PcadG.size==0:
+            units.append(par)
+            continue
+
+        ncut = np.floor(np.cumsum(cost) / target)
+        for i in np.unique(ncut):
+            idx = np.where(ncut==i)[0]
+            unit = dict(par)
+
+            # Stop half a cadence past the last period so that
+            # np.arange returns the same number of trial periods
+            # regardless of round off
+            unit['Pcad1'] = PcadG[idx[0]]
+            unit['Pcad2'] = PcadG[idx[-1]] + 0.5
+            unit['P1'] = unit['Pcad1'] * dt
+            unit['P2'] = unit['Pcad2'] * dt
+            units.append(unit)
+
+    return units
+
 def perGrid(tbase,ftdurmi,Pmin=100.,Pmax=None):
     """
     Period Grid
@@ -179,7 +625,11 @@ def perGrid(tbase,ftdurmi,Pmin=100.,Pmax=None):
     PG = np.array(PG)
     return PG
 
-def mtd(fm,twd):
+# Above this duration (cadences), mtd uses prefix sums rather than
+# direct convolution
+mtd_direct_max = 12
+
+def mtd(fm,twd,method='auto'):
     """
     Mean Transit Depth
 
@@ -191,6 +641,13 @@ def mtd(fm,twd):
     fm     : masked flux array.  masked regions enter into the average
              with 0 weight.
     twd    : Width of kernel in cadances
+    method : How to compute the box sums
+             - direct : np.convolve, O(N twd)
+             - cumsum : differences of prefix sums, O(N) (see mtd_batch)
+             - fft : scipy.signal.fftconvolve, O(N log N)
+             - auto : direct for twd <= mtd_direct_max, else cumsum.
+               A box is separable into prefix sums, which always beat
+               the FFT, so fft is never chosen automatically.
 
     Notes
     -----
@@ -200,6 +657,10 @@ def mtd(fm,twd):
     """
 
     assert isinstance(twd,int),"Box width most be integer number of cadences"
+    if method=='auto':
+        method = 'direct' if twd <= mtd_direct_max else 'cumsum'
+    if method=='cumsum':
+        return mtd_batch(fm,[twd])[0]
 
     fm = fm.copy()
     fm.fill_value = 0
@@ -213,8 +674,15 @@ def mtd(fm,twd):
     assert (np.isnan(f)==False).all() ,'mask out nans'
     kern = np.ones(twd,float)
 
-    ws = np.convolve(w*f,kern,mode='same') # Sum of points in bin
-    c = np.convolve(w,kern,mode='same')    # Number of points in bin
+    if method=='direct':
+        ws = np.convolve(w*f,kern,mode='same') # Sum of points in bin
+        c = np.convolve(w,kern,mode='same')    # Number of points in bin
+    elif method=='fft':
+        from scipy import signal
+        ws = signal.fftconvolve(w*f,kern,mode='same')
+        c = np.round(signal.fftconvolve(w,kern,mode='same'))
+    else:
+        assert False, "method must be auto, direct, cumsum, or fft"
 
     # Number of good points before, during, and after transit
     bc = c[:-2*twd]
@@ -225,7 +693,66 @@ def mtd(fm,twd):
     bws = ws[:-2*twd]
     tws = ws[twd:-twd]
     aws = ws[2*twd:]
-    dM = 0.5*(bws/bc + aws/ac) - tws/tc
+    return _mtd_combine(bws, bc, tws, tc, aws, ac, twd)
+
+def mtd_batch(fm,twdG):
+    """
+    Mean Transit Depth for several durations
+
+    Same as mtd, but the box sums for every duration are differences
+    of one set of prefix sums of the flux and weights, so each
+    duration costs O(N) regardless of twd.
+
+    np.convolve(a, ones(twd), mode='same')[i] is the sum of a over
+    [i - twd//2, i + (twd-1)//2]. Before and after transit, the box is
+    centered twd cadences earlier and later. Boxes are clipped at the
+    ends, which is the same as the zero padding in mtd.
+
+    Parameters
+    ----------
+    fm   : masked flux array
+    twdG : durations (cadences)
+
+    Returns
+    -------
+    dMG : list of dM (see mtd), one for each twd
+    """
+    fm = fm.copy()
+    fm.fill_value = 0
+    w = (~ma.getmaskarray(fm)).astype(int)
+    f = fm.filled()
+    assert (np.isnan(f)==False).all() ,'mask out nans'
+
+    # Prefix sums, extended with their first and last values so that
+    # every box is a difference of two contiguous slices
+    n = f.size
+    npad = 2 * int(max(twdG)) + 1
+    ws_cum = np.cumsum(np.hstack([np.zeros(npad + 1), w*f]))
+    c_cum = np.cumsum(np.hstack([np.zeros(npad + 1), w]))
+    ws_cum = np.hstack([ws_cum, np.zeros(npad) + ws_cum[-1]])
+    c_cum = np.hstack([c_cum, np.zeros(npad) + c_cum[-1]])
+
+    dMG = []
+    for twd in twdG:
+        assert int(twd)==twd,"Box width most be integer number of cadences"
+        twd = int(twd)
+        sums = []
+        for offset in [-twd, 0, twd]:
+            i1 = npad + offset - twd // 2
+            i2 = npad + offset + (twd - 1) // 2 + 1
+            sums += [
+                ws_cum[i2:i2 + n] - ws_cum[i1:i1 + n], 
+                c_cum[i2:i2 + n] - c_cum[i1:i1 + n]
+            ]
+
+        bws, bc, tws, tc, aws, ac = sums
+        dMG.append(_mtd_combine(bws, bc, tws, tc, aws, ac, twd))
+    return dMG
+
+def _mtd_combine(bws, bc, tws, tc, aws, ac, twd):
+    """Depth from the sums and counts before, during and after transit"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dM = 0.5*(bws/bc + aws/ac) - tws/tc
     dM = ma.masked_invalid(dM)
     dM.fill_value =0
 
@@ -235,7 +762,203 @@ def mtd(fm,twd):
 
     return dM
 
-def tdpep(t,fm,par):
+def lightcurve_fingerprint(fm):
+    """Hash of the unmasked flux values and the mask
+
+    Masked values enter as 0, so light curves that differ only under
+    the mask have the same fingerprint.
+    """
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(ma.filled(fm, 0), dtype=float).tobytes())
+    sha.update(np.ascontiguousarray(ma.getmaskarray(fm)).tobytes())
+    return sha.hexdigest()
+
+class MTDCache(object):
+    """Least recently used cache of single event statistics (mtd)
+
+    Entries are keyed by lightcurve_fingerprint(fm) and twd, so the
+    same light curve and duration is only convolved once, whether it
+    is requested by tdpep or by tval.DataValidation. 
+
+    Args:
+        max_bytes (Optional[int]) : memory budget. Least recently used
+            entries are evicted to stay below it.
+        spill_file (Optional[str]) : if set, evicted entries are
+            written to this h5 file (e.g. next to the pipeline h5
+            file) and read back on a miss rather than recomputed.
+    """
+    def __init__(self, max_bytes=256 * 2**20, spill_file=None):
+        self.max_bytes = max_bytes
+        self.spill_file = spill_file
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fm, twd, fingerprint=None, copy=True):
+        """Return mtd(fm, twd), computing it if needed
+
+        Args:
+            fm (masked array) : flux, see mtd
+            twd (int) : transit duration (cadences)
+            fingerprint (Optional[str]) : lightcurve_fingerprint(fm),
+                if already known
+            copy (Optional[bool]) : if False, return the cached array
+                itself, which must not be modified.
+
+        Returns:
+            dM (masked array) : see mtd
+        """
+        if fingerprint is None:
+            fingerprint = lightcurve_fingerprint(fm)
+        twd = _mtd_twd(twd)
+        key = (fingerprint, twd)
+        with self._lock:
+            dM = self._entries.pop(key, None)
+            if dM is not None:
+                self.hits += 1
+                self._entries[key] = dM
+
+        if dM is None:
+            dM = self._read_spill(key)
+            with self._lock:
+                if dM is None:
+                    self.misses += 1
+                else:
+                    self.spill_hits += 1
+            if dM is None:
+                dM = mtd(fm, twd)
+            self._put(key, dM)
+
+        if copy:
+            dM = dM.copy()
+        return dM
+
+    def get_batch(self, fm, twdG, fingerprint=None, copy=True):
+        """Return [mtd(fm, twd) for twd in twdG]
+
+        Durations that are not cached are computed together by
+        mtd_batch. Arguments are the same as get.
+        """
+        if fingerprint is None:
+            fingerprint = lightcurve_fingerprint(fm)
+        twdG = [_mtd_twd(twd) for twd in twdG]
+
+        dMG = {}
+        with self._lock:
+            for twd in twdG:
+                key = (fingerprint, twd)
+                if key in self._entries:
+                    self.hits += 1
+                    dMG[twd] = self._entries.pop(key)
+                    self._entries[key] = dMG[twd]
+
+        missing = []
+        for twd in twdG:
+            if twd in dMG:
+                continue
+            dM = self._read_spill((fingerprint, twd))
+            if dM is None:
+                missing.append(twd)
+            else:
+                dMG[twd] = dM
+                with self._lock:
+                    self.spill_hits += 1
+
+        if len(missing) > 0:
+            with self._lock:
+                self.misses += len(missing)
+            for twd, dM in zip(missing, mtd_batch(fm, missing)):
+                dMG[twd] = dM
+
+        for twd in twdG:
+            self._put((fingerprint, twd), dMG[twd])
+        
+        dMG = [dMG[twd] for twd in twdG]
+        if copy:
+            dMG = [dM.copy() for dM in dMG]
+        return dMG
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def reset(self, spill_file=None):
+        """Drop all entries and counters and set a new spill_file
+
+        The cache is module level, so a long lived process that works
+        through many stars (e.g. a `terra batch` worker) should reset
+        it for every star. Otherwise it holds up to max_bytes of light
+        curves that will not be seen again.
+        """
+        self.clear()
+        with self._lock:
+            self.spill_file = spill_file
+            self.hits = 0
+            self.misses = 0
+            self.spill_hits = 0
+
+    def _put(self, key, dM):
+        nbytes = _mtd_nbytes(dM)
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                return
+            while self._entries and self.nbytes + nbytes > self.max_bytes:
+                old = self._entries.popitem(last=False)
+                self.nbytes -= _mtd_nbytes(old[1])
+                evicted.append(old)
+            if nbytes <= self.max_bytes:
+                self._entries[key] = dM
+                self.nbytes += nbytes
+            else:
+                evicted.append((key, dM))
+
+        for old in evicted:
+            self._write_spill(*old)
+
+    def _path(self, key):
+        return '{}/{}'.format(*key)
+
+    def _read_spill(self, key):
+        if self.spill_file is None or not os.path.exists(self.spill_file):
+            return None
+        import h5py
+        with self._lock, h5py.File(self.spill_file, 'r') as h5:
+            path = self._path(key)
+            if path not in h5:
+                return None
+            dM = ma.masked_array(
+                h5[path + '/data'][:], h5[path + '/mask'][:], fill_value=0
+            )
+        return dM
+
+    def _write_spill(self, key, dM):
+        if self.spill_file is None:
+            return
+        import h5py
+        with self._lock, h5py.File(self.spill_file, 'a') as h5:
+            path = self._path(key)
+            if path in h5:
+                return
+            h5[path + '/data'] = dM.data
+            h5[path + '/mask'] = ma.getmaskarray(dM)
+
+def _mtd_twd(twd):
+    """twd as an int, so that 5 and 5.0 share a cache entry"""
+    assert int(twd)==twd,"Box width most be integer number of cadences"
+    return int(twd)
+
+def _mtd_nbytes(dM):
+    return dM.data.nbytes + ma.getmaskarray(dM).nbytes
+
+# Shared by tdpep and tval.DataValidation
+mtd_cache = MTDCache()
+
+def tdpep(t,fm,par,dtype=float,workspace=None):
     """
     Transit-duration - Period - Epoch
 
@@ -246,6 +969,9 @@ def tdpep(t,fm,par):
     P1   : First period (cadences)
     P2   : Last period (cadences)
     twdG : Grid of transit durations (cadences)
+    dtype : dtype of the single event statistic handed to the FFA
+    workspace : Workspace holding the FFA work buffer. If None, a
+           workspace is created for this call.
 
     Returns
     -------
@@ -265,12 +991,21 @@ def tdpep(t,fm,par):
 
     ntwd  = len(twdG)
 
+    # One workspace for the streaming FFA, big enough for the longest
+    # base period and reused across periods and durations
+    if workspace is None:
+        workspace = Workspace()
+    ws = workspace.get('ffa', 4 * (fm.size + int(PcadG.max())), np.float32)
+    dMG = mtd_cache.get_batch(fm, twdG, copy=False)
+
     rtd = []
     for i in range(ntwd):     # Loop over twd
         twd = twdG[i]
-        dM  = mtd(fm,twd)
+        dM  = dMG[i].astype(dtype)
+        x = np.ascontiguousarray(dM.data, dtype=np.float32)
+        w = (~ma.getmaskarray(dM)).astype(np.float32)
 
-        func = lambda Pcad: ep(dM,Pcad)
+        func = lambda Pcad: ep(dM,Pcad,ws=ws,x=x,w=w)
         rep = map(func,PcadG)
         rep = np.hstack(rep)
         r   = np.empty(rep.size, dtype=tddtype)
@@ -284,7 +1019,7 @@ def tdpep(t,fm,par):
     rtd['s2n'] = rtd['mean']/rtd['noise']*np.sqrt(rtd['count'])
     return rtd
 
-def ep(dM,Pcad0):
+def ep(dM,Pcad0,ws=None,x=None,w=None):
     """
     Search from Pcad0 to Pcad0+1
 
@@ -292,6 +1027,7 @@ def ep(dM,Pcad0):
     ----------
     dM    : Transit depth estimator
     Pcad0 : Number of cadances to foldon
+    ws, x, w : passed to fold_ffa
  
     Returns the following information:
     - 'mean'   : Average of the folded columns (does not count masked items)
@@ -300,18 +1036,35 @@ def ep(dM,Pcad0):
     - 'Pcad'   : Periods that the FFA computed MES 
     """
     
-    t0cad,Pcad,meanF,countF = fold_ffa(dM,Pcad0)
+    t0cad,Pcad,meanF,countF = fold_ffa(dM,Pcad0,ws=ws,x=x,w=w)
     rep = epmarg(t0cad,Pcad,meanF,countF)
     return rep
 
-def fold_ffa(dM,Pcad0):
+def fold_ffa(dM,Pcad0,ws=None,x=None,w=None):
     """
     Fold on M periods from Pcad0 to Pcad+1 where M is N / Pcad0
-    rounded up to the nearest power of 2.
+    rounded up.
+
+    Uses the streaming FFA, which reads dM in place rather than
+    wrapping it into a padded array, so M need not be a power of 2.
+
+    This changes the trial periods of mode='ffa'. They used to be
+    spaced by 1 / (M2 - 1), with M2 the next power of 2 above N /
+    Pcad0, and are now spaced by 1 / (M - 1). The grid is up to 2x
+    coarser, but the step still matches the drift of one column
+    over the light curve, which is all the FFA resolves. When N /
+    Pcad0 rounds up to a power of 2 the grid and the folds are the
+    same as before (see test_FFAStream).
+
     Parameters
     ----------
     dM    : Transit depth estimator
     Pcad0 : Number of cadances to foldon
+    ws    : float32 workspace with at least 4 * (N + Pcad0) elements,
+            reused across calls. If None, one is allocated.
+    x, w  : dM.data and the weights (1 = good, 0 = masked) as
+            contiguous float32 arrays. Pass them when folding the
+            same dM on many periods to skip the conversion.
  
     Returns
     -------
@@ -333,25 +1086,26 @@ def fold_ffa(dM,Pcad0):
     P3 |  .   .   .       .
     """
 
-    dMW = FFA.XWrap2(dM,Pcad0,pow2=True)
-    M   = dMW.shape[0]  # number of rows
+    Pcad0 = int(Pcad0)
+    if x is None:
+        x = np.ascontiguousarray(ma.getdata(dM), dtype=np.float32)
+    if w is None:
+        w = (~ma.getmaskarray(dM)).astype(np.float32)
+
+    # Sum of array elements folded on P0, P0 + i/(M-1) and the number
+    # of valid data points
+    sumF,countF = FFA.FFAStream(x,w,Pcad0,ws)
+    M   = sumF.shape[0]  # number of rows
 
     idCol = np.arange(Pcad0,dtype=int)   # id of each column
     idRow = np.arange(M,dtype=int)       # id of each row
 
     t0cad = idCol.astype(float)
-    Pcad  = Pcad0 + idRow.astype(float) / (M - 1)
-
-    dMW.fill_value=0
-    data = dMW.filled()
-    mask = (~dMW.mask).astype(int)
-
-    sumF   = FFA.FFA(data) # Sum of array elements folded on P0, P0 + i/(1-M)
-    countF = FFA.FFA(mask) # Number of valid data points
+    Pcad  = Pcad0 + idRow.astype(float) / max(M - 1, 1)
     meanF  = sumF/countF
     return t0cad,Pcad,meanF,countF
 
-def pgram_max(t,fm,par):
+def pgram_max(t,fm,par,plan_cache=None,dtype=float,workspace=None,ncand=0):
     """
     Periodogram: Check max values
 
@@ -369,10 +1123,21 @@ def pgram_max(t,fm,par):
           - Pcad1 (lower period limit)
           - Pcad2 (upper period limit)
           - twdG (grid of trial durations to compute)
+    plan_cache : FoldPlanCache. Fold plans are computed once per block
+          of periods and shared across the trial durations. If None, a
+          cache is created for this call.
+    dtype : dtype of the single event statistic handed to the folding
+          kernel (float64 or float32).
+    workspace : Workspace for the periodogram and column work
+          buffers. If None, a workspace is created for this call.
+    ncand : If > 0, also return the state needed by pgram_max_update:
+          the ncand best columns of every period and duration.
 
     Returns
     -------
     pgram : Record array with following fields
+    state : (if ncand > 0) dict with par, PcadG, and the candidate
+          arrays
 
     """
     ncad = fm.size
@@ -380,9 +1145,11 @@ def pgram_max(t,fm,par):
     get_frac_Pcad = lambda P : np.arange(P,P+1,1.0*P / ncad)
     PcadG = np.hstack(map(get_frac_Pcad,PcadG))
     twdG = par['twdG']
+    if plan_cache is None:
+        plan_cache = FoldPlanCache(ncad)
+    if workspace is None:
+        workspace = Workspace()
     
-    icad = np.arange(ncad)
-
     dtype_pgram = [
         ('Pcad',float),
         ('twd',float),
@@ -393,20 +1160,22 @@ def pgram_max(t,fm,par):
         ('noise',float),
         ]
 
-    pgram = np.zeros( (len(twdG),len(PcadG)),dtype=dtype_pgram)
+    pgram = workspace.get(
+        'pgram_max', (len(twdG),len(PcadG)), dtype_pgram, fill=0
+    )
+    state = _pgram_max_state(par, PcadG, len(twdG), ncand)
 
-    # dtype of the record array returned from tdpep()
-    dtype_temp = [
-        ('c',int),
-        ('mean',float),
-        ('s2n',float),
-        ('col',int),
-        ('t0',float)
-    ] 
+    # Column work arrays for fold.pgram_max_block, sized for the
+    # longest period in the segment
+    ncolmax = int(np.floor(PcadG.max())) + 1 if PcadG.size > 0 else 1
+    work = workspace.get('pgram_max_work', (ncolmax, 3))
+    iwork = workspace.get('pgram_max_iwork', (ncolmax, 2), np.int64)
 
-    # Loop over different transit durations
+    # Compute the single event statistic for different transit durations
+    res_1d = foreman_mackey_1d_batch(fm,twdG)
+    dMG = []
     for itwd,twd in enumerate(twdG):
-        res = foreman_mackey_1d(fm,twd)    
+        res = res_1d[itwd]
         dM = ma.masked_array(
             res['depth_1d'],
             ~res['good_trans'].astype(bool),
@@ -417,88 +1186,318 @@ def pgram_max(t,fm,par):
         noise = ma.median( ma.abs(dM) ) * 1.5
         pgram[itwd,:]['noise'] = noise
         pgram[itwd,:]['twd'] = twd
-        for iPcad,Pcad in enumerate(PcadG):
-            # Compute row and columns for folded data
-            row,col = wrap_icad(icad,Pcad)
+
+        data = np.ascontiguousarray(dM.data, dtype=dtype)
+        mask = ma.getmaskarray(dM).view(np.uint8)
+        dMG.append((data, mask, noise))
+
+    # Loop over blocks of periods, reusing the fold plan for each
+    # transit duration
+    for i1 in range(0, PcadG.size, plan_cache.block_size):
+        i2 = i1 + plan_cache.block_size
+        PcadB = PcadG[i1:i2]
+        cols, ncols = plan_cache.get(PcadB)
+        for itwd,twd in enumerate(twdG):
+            # Fold on every trial period, clip the top two values in
+            # each column, and keep the column with the highest s2n
+            # that survives the cuts (see fold.pgram_max_block and
+            # cumsum_top).  The mean transit depth after removing the
+            # deepest transit and the second deepest transit must be >
+            # 0.5 it's former value. Also, require 3 transits.
+            data, mask, noise = dMG[itwd]
+            cand = ()
+            if ncand > 0:
+                cand = [state[k][itwd,i1:i2] for k in _cand_keys]
+            mean, s2n, c, col = fold.pgram_max_block(
+                data, mask, PcadB, noise, cols, ncols, work, iwork, *cand
+            )
+
+            # col = -1 marks periods where no column passed the
+            # cuts. For t0, add half the transit with because column
+            # index corresponds in ingress
+            b = col >= 0
+            r = pgram[itwd,i1:i2]
+            r['mean'][b] = mean[b]
+            r['s2n'][b] = s2n[b]
+            r['c'][b] = c[b]
+            r['t0'][b] = ( col[b] + twd / 2.0) * config.lc + t[0] 
+            r['Pcad'][b] = PcadB[b]
             
-            ncol = np.max(col) + 1
-            nrow = np.max(row) + 1
-            icol = np.arange(ncol)
-
-            # Shove data and mask into appropriate positions
-            data = np.zeros((nrow,ncol))
-            mask = np.ones((nrow,ncol)).astype(bool)
-            data[row,col] = dM.data
-            mask[row,col] = dM.mask
-
-            # Sum along columns (clipping top 0, 1, 2 values)
-            datasum,datacnt = cumsum_top(data,mask,2)
-            # datasum[-1] are the is the summed columns having not
-            # clipped any values. Update results array. For t0, add
-            # half the transit with because column index corresponds
-            # in ingress
-            s = datasum[-1,:]
-            c = datacnt[-1,:]
-            r = np.zeros(ncol,dtype=dtype_temp)
-            r['s2n'] = -1 
-            r['mean'] = s/c
-            r['s2n'] = s / np.sqrt(c) / noise            
-            r['c'][:] = c
-            r['col'] = icol
-            r['t0'] = ( r['col'] + twd / 2.0) * config.lc + t[0] 
-
-            # Compute mean transit depth after removing the deepest
-            # transit, datacnt[-2], and the second deepest transit,
-            # datacnt[-3]. The mean transit depth must be > 0.5 it's
-            # former value. Also, require 3 transits.
-            mean_clip1 = datasum[-2] / datacnt[-2]
-            mean_clip2 = datasum[-3] / datacnt[-3]
-            b = (
-                (mean_clip1 > 0.5 * r['mean'] ) & 
-                (mean_clip2 > 0.5 * r['mean']) & 
-                (r['c'] >= 3)
+    # Compute the maximum return twd with the maximum s2n. Fancy
+    # indexing copies, so the result does not share the workspace
+    pgram = pgram[np.argmax(pgram['s2n'],axis=0),np.arange(pgram.shape[1])]
+    if ncand > 0:
+        return pgram, state
+    return pgram
+
+_cand_keys = ['cand_col', 'cand_s', 'cand_c', 'cand_floor']
+
+def _pgram_max_state(par, PcadG, ntwd, ncand):
+    """Candidate columns kept by pgram_max for pgram_max_update"""
+    if ncand==0:
+        return None
+    shape = (ntwd, PcadG.size)
+    return dict(
+        par=par, PcadG=PcadG,
+        cand_col=np.zeros(shape + (ncand,), dtype=np.int32) - 1,
+        cand_s=np.zeros(shape + (ncand,)),
+        cand_c=np.zeros(shape + (ncand,)),
+        cand_floor=np.zeros(shape) - np.inf,
+    )
+
+def pgram_max_update(t,fm,changed,state,dtype=float):
+    """
+    Update a pgram_max periodogram after some cadences changed
+
+    The single event statistic at cadence i depends on the flux in
+    [i, i + twd), so it is recomputed everywhere, and the cadences
+    within twd - 1 before a changed cadence are handed to
+    fold.pgram_max_update, which folds only their columns again. The
+    result matches pgram_max on the new flux.
+
+    Parameters
+    ----------
+    t : t[0] provides starting time
+    fm : new masked array with fluxes
+    changed : (bool) cadences where flux or mask changed
+    state : state returned by pgram_max (ncand > 0) or a previous call
+          to this function. Updated in place; state['nfull'] is set to
+          the number of periods that were folded again in full.
+    dtype : see pgram_max
+
+    Returns
+    -------
+    pgram : see pgram_max
+    """
+    par = state['par']
+    PcadG = state['PcadG']
+    twdG = par['twdG']
+    ncad = fm.size
+
+    dtype_pgram = [
+        ('Pcad',float),
+        ('twd',float),
+        ('s2n',float),
+        ('c',float),
+        ('mean',float),
+        ('t0',float),
+        ('noise',float),
+        ]
+    pgram = np.zeros( (len(twdG),len(PcadG)),dtype=dtype_pgram)
+
+    res_1d = foreman_mackey_1d_batch(fm,twdG)
+    changed_cum = np.hstack([0, np.cumsum(changed)])
+    icad = np.arange(ncad)
+    nfull = 0
+    for itwd,twd in enumerate(twdG):
+        res = res_1d[itwd]
+        dM = ma.masked_array(
+            res['depth_1d'],
+            ~res['good_trans'].astype(bool),
+            fill_value=0
             )
+        noise = ma.median( ma.abs(dM) ) * 1.5
+        pgram[itwd,:]['noise'] = noise
+        pgram[itwd,:]['twd'] = twd
 
-            if ~np.any(b):
-                continue 
+        data = np.ascontiguousarray(dM.data, dtype=dtype)
+        mask = ma.getmaskarray(dM).view(np.uint8)
+        cad2 = np.minimum(icad + int(twd), ncad)
+        icad_aff = np.where(changed_cum[cad2] - changed_cum[icad] > 0)[0]
 
-            rcut = r[b]
-            rmax = rcut[np.argmax(rcut['s2n'])]
-            names = ['mean','s2n','c','t0']
-            for n in names:
-                pgram[itwd,iPcad][n] = rmax[n]
-            pgram[itwd,iPcad]['Pcad'] = Pcad
-            
-    # Compute the maximum return twd with the maximum s2n
+        cand = [state[k][itwd] for k in _cand_keys]
+        mean, s2n, c, col, _nfull = fold.pgram_max_update(
+            data, mask, PcadG, noise, icad_aff.astype(np.int64), *cand
+        )
+        nfull += _nfull
+
+        b = col >= 0
+        r = pgram[itwd]
+        r['mean'][b] = mean[b]
+        r['s2n'][b] = s2n[b]
+        r['c'][b] = c[b]
+        r['t0'][b] = ( col[b] + twd / 2.0) * config.lc + t[0] 
+        r['Pcad'][b] = PcadG[b]
+
+    state['nfull'] = nfull
     pgram = pgram[np.argmax(pgram['s2n'],axis=0),np.arange(pgram.shape[1])]
     return pgram
 
-def bls(t,fm,par):
+class Workspace(object):
+    """Reusable work buffers for the folding kernels
+
+    Buffers are named and handed out as views. A buffer is only
+    (re)allocated when a request is larger than what is held, so the
+    per-period work arrays are allocated about once per segment rather
+    than once per trial period. Each thread gets its own buffers, so
+    the thread backend can share one Grid.
+
+    Views returned by `get` are overwritten by the next call for the
+    same name, so anything returned to the caller must be copied.
+
+    Attributes:
+        nalloc (int) : number of allocations since reset_stats
+        nbytes_alloc (int) : bytes allocated since reset_stats
+        nbytes (int) : bytes currently held, all threads
     """
+    def __init__(self):
+        self.nbytes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.nalloc = 0
+            self.nbytes_alloc = 0
+
+    def stats(self):
+        """Return the allocation counters as a dict"""
+        with self._lock:
+            return dict(
+                nalloc=self.nalloc, nbytes_alloc=self.nbytes_alloc, 
+                nbytes=self.nbytes
+            )
+
+    def get(self, name, shape, dtype=float, fill=None):
+        """Return a view of buffer `name` with shape and dtype
+
+        Args:
+            name (str) : buffer name
+            shape (int or tuple) : shape of the view
+            dtype (Optional) : numpy dtype, may be a record dtype
+            fill (Optional) : if given, the view is set to this value
+
+        Returns:
+            buf (numpy array) : view into the buffer
+        """
+        if not hasattr(self._local, 'buffers'):
+            self._local.buffers = {}
+        buffers = self._local.buffers
+
+        shape = tuple(int(n) for n in np.atleast_1d(shape))
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+
+        buf = buffers.get(name)
+        if buf is None or buf.dtype!=dtype or buf.size < size:
+            new = np.empty(size, dtype=dtype)
+            with self._lock:
+                self.nalloc += 1
+                self.nbytes_alloc += new.nbytes
+                self.nbytes += new.nbytes
+                if buf is not None:
+                    self.nbytes -= buf.nbytes
+            buf = buffers[name] = new
+
+        buf = buf[:size].reshape(shape)
+        if fill is not None:
+            buf[...] = fill
+        return buf
+
+class FoldPlanCache(object):
+    """Least recently used cache of fold plans
+
+    A fold plan (see fold.fold_plan) stores the column of every cadence
+    for a block of trial periods as int32. Plans only depend on the
+    periods, so they are shared across trial durations and across
+    repeated searches of the same light curve.
+
+    Args:
+        ncad (int) : number of cadences in the light curve
+        max_bytes (Optional[int]) : memory budget. Least recently used
+            plans are evicted to stay below it. Also sets the number
+            of periods in a block.
+    """
+    def __init__(self, ncad, max_bytes=64 * 2**20):
+        self.ncad = ncad
+        self.max_bytes = max_bytes
+        self.block_size = max(1, int(max_bytes / (4 * ncad)))
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._plans = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, PcadG):
+        """Return (cols, ncols) for PcadG, computing it if needed"""
+        key = PcadG.tobytes()
+        with self._lock:
+            if key in self._plans:
+                self.hits += 1
+                plan = self._plans.pop(key)
+                self._plans[key] = plan
+                return plan
+            self.misses += 1
+
+        plan = fold.fold_plan(np.ascontiguousarray(PcadG, float), self.ncad)
+        nbytes = plan[0].nbytes + plan[1].nbytes
+        with self._lock:
+            while self._plans and self.nbytes + nbytes > self.max_bytes:
+                _, old = self._plans.popitem(last=False)
+                self.nbytes -= old[0].nbytes + old[1].nbytes
+            if nbytes <= self.max_bytes:
+                self._plans[key] = plan
+                self.nbytes += nbytes
+        return plan
+
+def bls(t,fm,par,plan_cache=None,dtype=float,workspace=None):
+    """
+    Box least squares periodogram
+
+    Folds on every trial period and finds the box (starting column and
+    width between twdG[0] and twdG[-1] columns) with the highest s2n.
+    The work is done in blocks of periods by fold.bls_block, which
+    reuses the fold plans of pgram_max.
+
+    Parameters 
+    ----------
+    t : t[0] provides starting time
+    fm : masked array with fluxes
+    par : dict with following keys
+          - Pcad1 (lower period limit)
+          - Pcad2 (upper period limit)
+          - twdG (grid of trial durations to compute)
+    plan_cache : FoldPlanCache. If None, a cache is created for this
+          call.
+    dtype : dtype of the data handed to the folding kernel (float64 or
+          float32).
+    workspace : Workspace for the prefix sum buffer. If None, a
+          workspace is created for this call.
+
+    Returns
+    -------
+    pgram : Record array with fields col, twd, s2n, Pcad, noise, mean
     """
     ncad = fm.size
     PcadG = np.arange(par['Pcad1'],par['Pcad2'])
     get_frac_Pcad = lambda P : np.arange(P,P+1,1.0*P / ncad)
     PcadG = np.hstack(map(get_frac_Pcad,PcadG))
+    if plan_cache is None:
+        plan_cache = FoldPlanCache(ncad)
+    if workspace is None:
+        workspace = Workspace()
 
-    data = fm.data
-    mask = fm.mask.astype(int)
-    icad = np.arange(fm.size)
+    data = np.ascontiguousarray(fm.data, dtype=dtype)
+    mask = ma.getmaskarray(fm).view(np.uint8)
+
+    twd1 = int(par['twdG'][0])
+    twd2 = int(par['twdG'][-1])
 
-    twd1 = par['twdG'][0]
-    twd2 = par['twdG'][-1]
+    ncolmax = int(np.floor(PcadG.max())) + 1 if PcadG.size > 0 else 1
+    work = workspace.get('bls_work', (ncolmax + twd2 + 1, 3))
 
     dtype = [('col',int),('twd',float),('s2n',float),('Pcad',float),('noise',float),('mean',float)]
     pgram = np.zeros(PcadG.size,dtype)
-    for i,Pcad in enumerate(PcadG):
-        row,col = wrap_icad(icad,Pcad)
-        ccol,scol,sscol = fold.fold_col(data,mask,col)
-        ncol = np.max(col) + 1
-        r = pgram[i]
-        r['s2n'],r['twd'],r['col'],r['mean'],r['noise'] = fold.bls(
-            ccol,scol,sscol,ncol,twd1,twd2
+    pgram['Pcad'] = PcadG
+    for i1 in range(0, PcadG.size, plan_cache.block_size):
+        i2 = i1 + plan_cache.block_size
+        PcadB = PcadG[i1:i2]
+        cols, ncols = plan_cache.get(PcadB)
+        r = pgram[i1:i2]
+        r['s2n'],r['twd'],r['col'],r['mean'],r['noise'] = fold.bls_block(
+            data, mask, PcadB, twd1, twd2, cols, ncols, work
         )
-        r['Pcad'] = Pcad
     pgram['mean'] *= -1
     return pgram
 
@@ -530,8 +1529,35 @@ dtype = [
 dtype_fm_res = np.dtype(dtype)
 
 
-def foreman_mackey(t,fm,par):
+def foreman_mackey(t,fm,par,plan_cache=None,dtype=float,workspace=None):
     """
+    Foreman-Mackey periodogram
+
+    Fits a box to every cadence for each trial duration (see
+    foreman_mackey_1d_batch), then combines the single transit fits at
+    every phase of every trial period. The work is done in blocks of
+    periods by fold.foreman_mackey_block, which returns only the best
+    phase and duration of each period.
+
+    Parameters 
+    ----------
+    t : t[0] provides starting time
+    fm : masked array with fluxes
+    par : dict with following keys
+          - Pcad1 (lower period limit)
+          - Pcad2 (upper period limit)
+          - twdG (grid of trial durations to compute)
+    plan_cache : FoldPlanCache. If None, a cache is created for this
+          call.
+    dtype : dtype of the single transit fits handed to the folding
+          kernel (float64 or float32).
+    workspace : Workspace for the column work buffer. If None, a
+          workspace is created for this call.
+
+    Returns
+    -------
+    pgram : Record array with dtype_fm_res. Periods where no phase
+            passed the cuts are left as zeros.
     """
     ncad = fm.size
     Pcad1 = par['Pcad1']
@@ -543,149 +1569,114 @@ def foreman_mackey(t,fm,par):
     get_frac_Pcad = lambda P : np.arange(P,P+1,1.0*P / ncad)
     PcadG = np.hstack(map(get_frac_Pcad,PcadG))
     nPcad = PcadG.size
+    if plan_cache is None:
+        plan_cache = FoldPlanCache(ncad)
+    if workspace is None:
+        workspace = Workspace()
 
-    res_1d = map(lambda x : foreman_mackey_1d(fm,x), twdG)
-    res_1d = np.vstack(res_1d)
+    res_1d = foreman_mackey_1d_batch(fm,twdG)
+    good = res_1d['good_trans'].astype(np.uint8)
+    depth = np.ascontiguousarray(res_1d['depth_1d'], dtype=dtype)
+    ivar = np.ascontiguousarray(res_1d['depth_ivar_1d'], dtype=dtype)
+    dll = np.ascontiguousarray(res_1d['dll_1d'], dtype=dtype)
 
+    ncolmax = int(np.floor(PcadG.max())) + 1 if PcadG.size > 0 else 1
+    work = workspace.get('fm_work', (ncolmax, 5))
 
     pgram = np.zeros(nPcad,dtype=dtype_fm_res)
-    
-    for i,Pcad in enumerate(PcadG):
-        res = fold.forman_mackey_max(
-            Pcad, 
-            alpha, 
-            res_1d['good_trans'],
-            res_1d['dll_1d'],
-            res_1d['depth_1d'],
-            res_1d['depth_ivar_1d']
+    for i1 in range(0, nPcad, plan_cache.block_size):
+        i2 = i1 + plan_cache.block_size
+        PcadB = PcadG[i1:i2]
+        cols, ncols = plan_cache.get(PcadB)
+        res = fold.foreman_mackey_block(
+            good, depth, ivar, dll, PcadB, alpha, cols, ncols, work
         )
+        res = dict(zip(dtype_fm_max_res.names, res))
 
-        for iname,name in enumerate(dtype_fm_max_res.names):
-            pgram[i][name] = res[iname]
-
-        pgram[i]['Pcad'] = Pcad
-#        pgram[i]['twd'] = twdG[pgram[i]['itwd']]
+        b = res['itwd'] >= 0
+        r = pgram[i1:i2]
+        for name in dtype_fm_max_res.names:
+            r[name][b] = res[name][b]
+        r['twd'][b] = np.array(twdG)[res['itwd'][b]]
+        r['Pcad'][b] = PcadB[b]
 
     return pgram
 
-def foreman_mackey(t,fm,par):
-    """
-    """
-    ncad = fm.size
-    Pcad1 = par['Pcad1']
-    Pcad2 = par['Pcad2']
-    twdG = par['twdG']
-    ntwd = len(twdG)
-    alpha = 1200.0
-
-    PcadG = np.arange(Pcad1, Pcad2)
-    get_frac_Pcad = lambda P : np.arange(P,P+1,1.0*P / ncad)
-    PcadG = np.hstack(map(get_frac_Pcad,PcadG))
-    nPcad = PcadG.size
-
-    icad = np.arange(fm.size)
-    data = fm.data
-    mask = fm.mask.astype(int)
+dtype = [
+    ('good_trans', int),
+    ('depth_1d', float), 
+    ('depth_ivar_1d', float), 
+    ('dll_1d', float), 
+]
 
-    res_1d = map(lambda x : foreman_mackey_1d(fm,x), twdG)
-    res_1d = np.vstack(res_1d)
+dtype_fm_1d = np.dtype(dtype)
 
-    pgram = np.zeros(nPcad,dtype=dtype_fm_res)
+def foreman_mackey_1d(fm,twd):
+    """
+    Single event statistics for a single transit duration
 
-    dtype = [
-        ('col', int), 
-        ('phic_same',float),
-        ('phic_variable',float),
-        ('depth_2d',float), 
-        ('depth_ivar_2d',float),
-        ('nind',int),
-        ('idx',int),
-        ('twd',int),
-    ]
-    
-    for i,Pcad in enumerate(PcadG):
-        row,col = wrap_icad(icad,Pcad)
-        ncol = np.max(col) + 1
-        res_temp = np.zeros((ntwd,ncol),dtype=dtype)
-        res_temp['phic_same'] -= np.inf
-        res_temp['phic_variable'] -= np.inf
+    See foreman_mackey_1d_batch.
+    """
+    return foreman_mackey_1d_batch(fm, [twd])[0]
 
-        for itwd,twd in enumerate(twdG):
-            col, phic_same, phic_variable, depth_2d, depth_ivar_2d, nind = \
-                fold.forman_mackey(
-                    Pcad, 
-                    alpha, 
-                    res_1d[itwd]['good_trans'], 
-                    res_1d[itwd]['dll_1d'], 
-                    res_1d[itwd]['depth_1d'], 
-                    res_1d[itwd]['depth_ivar_1d'], 
-                )
-
-
-            res_temp[itwd]['col'] = col
-            res_temp[itwd]['phic_same'] = phic_same
-            res_temp[itwd]['phic_variable'] = phic_variable
-            res_temp[itwd]['depth_2d'] = depth_2d
-            res_temp[itwd]['depth_ivar_2d'] = depth_ivar_2d
-            res_temp[itwd]['nind'] = nind
-            res_temp[itwd]['twd'] = twd
-
-        res_temp = res_temp.flatten()
-        res_temp = res_temp[
-            (res_temp['depth_2d'] > 0.0 ) &
-            (res_temp['phic_same'] > res_temp['phic_variable']) &
-            (res_temp['nind'] >= 2)
-            ]
+def foreman_mackey_1d_batch(fm,twdG):
+    """
+    Single event statistics for all trial durations
 
-        if res_temp.size==0:
-            continue 
+    For every cadence, fit a box of width twd starting at that cadence
+    and compute the depth, inverse variance of the depth, and the
+    change in log-likelihood relative to no transit. Masked points
+    enter with a value of 0.
 
-        res_max = res_temp[res_temp['phic_same'].argmax()]
+    The box sums come from prefix sums of the flux and the number of
+    good points, so each duration costs O(ncad) regardless of twd. With s, c, and n the sum, number of good
+    points, and number of points in the box, and m = s / c,
 
-        pgram[i]['phic_same'] = res_max['phic_same']
-        pgram[i]['phic_variable'] = res_max['phic_variable']
-        pgram[i]['depth_2d'] = res_max['depth_2d']
-        pgram[i]['depth_ivar_2d'] = res_max['depth_ivar_2d']
-        pgram[i]['nind'] = res_max['nind']
-        pgram[i]['col'] = res_max['col']
-        pgram[i]['twd'] = res_max['twd']
-        pgram[i]['Pcad'] = Pcad        
+        dll = ivar * (m * s - 0.5 * n * m**2)
 
-    return pgram
+    Parameters
+    ----------
+    fm : masked flux array. fill_value must be 0.
+    twdG : trial durations (cadences)
 
-def foreman_mackey_1d(fm,twd):
+    Returns
+    -------
+    res : record array with shape = (len(twdG), ncad) and the
+          following fields
+          - good_trans : 1 if more than half the box is good data
+          - depth_1d : transit depth
+          - depth_ivar_1d : inverse variance of depth_1d
+          - dll_1d : delta log-likelihood
+    """
     assert fm.fill_value==0,'fill_value must = 0'
     assert np.sum(np.isnan(fm.compressed()))==0,'mask out nans'
 
-    dtype = [
-        ('good_trans', int),
-        ('depth_1d', float), 
-        ('depth_ivar_1d', float), 
-        ('dll_1d', float), 
-    ]
-
     ncad = len(fm)
     fmfilled = fm.filled()
+    good = (~ma.getmaskarray(fm)).astype(int)
 
     # Compute inverse varience
     ivar = 1.0 / np.median(np.diff(fm.compressed()) ** 2)
-    res = np.zeros(ncad,dtype=dtype)
-
-    for cad1 in range(ncad):
-        cad2 = int(cad1 + twd) 
-        data = fmfilled[cad1:cad2]
-        mask = fm.mask[cad1:cad2]
-        s = np.sum(data)
-        c = np.sum(~mask)
-        m = s / c
-        res['depth_1d'][cad1] = -1.0 * m 
-        ll0 = -0.5 * np.sum(data**2) * ivar 
-        ll = -0.5 * np.sum( (data - m )**2 ) * ivar 
-        res['dll_1d'][cad1] = ll - ll0
-        res['depth_ivar_1d'][cad1] = ivar * c
-        
-        if c > twd / 2:
-            res['good_trans'][cad1] = 1
+    res = np.zeros( (len(twdG),ncad), dtype=dtype_fm_1d)
+
+    # Prefix sums. sum(x[cad1:cad2]) = x_cum[cad2] - x_cum[cad1]
+    f_cum = np.hstack([0, np.cumsum(fmfilled)])
+    c_cum = np.hstack([0, np.cumsum(good)])
+
+    cad1 = np.arange(ncad)
+    for itwd,twd in enumerate(twdG):
+        cad2 = (cad1 + twd).astype(int)
+        cad2 = np.minimum(cad2, ncad)
+        n = cad2 - cad1
+        s = f_cum[cad2] - f_cum[cad1]
+        c = c_cum[cad2] - c_cum[cad1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m = s / c
+
+        res[itwd]['depth_1d'] = -1.0 * m
+        res[itwd]['dll_1d'] = ivar * (m * s - 0.5 * n * m**2)
+        res[itwd]['depth_ivar_1d'] = ivar * c
+        res[itwd]['good_trans'] = (c > twd / 2).astype(int)
 
     return res
 
@@ -775,7 +1766,7 @@ def _periodogram_parameters_segment(P1, P2, tbase, Rstar=1, Mstar=1,
     return d
 
 def periodogram_parameters(P1, P2, tbase, nseg, Rstar=1.0, Mstar=1.0, 
-                           ftdur=[0.5,1.5]):
+                           ftdur=[0.5,1.5], partition='log'):
     """
     Periodogram Parameters.
 
@@ -788,10 +1779,23 @@ def periodogram_parameters(P1, P2, tbase, nseg, Rstar=1.0, Mstar=1.0,
              compute expected duration.
         ftdur (Optional[list]) : Fraction of expected maximum tranit duration 
              to search over.
+        partition (Optional[str]) : How to place the segment boundaries
+            - log : logrithmically spaced in period (default)
+            - cost : segments of equal estimated cost (see `segment_cost`).
+              Short period segments are much more expensive, so this
+              keeps the first segment from dominating a parallel search.
     """
 
-    # Split the periods into logrithmically spaced segments
-    PlimArr = np.logspace( np.log10(P1) , np.log10(P2),nseg+1  )
+    if partition=='log':
+        # Split the periods into logrithmically spaced segments
+        PlimArr = np.logspace( np.log10(P1) , np.log10(P2),nseg+1  )
+    elif partition=='cost':
+        PlimArr = _equal_cost_limits(
+            P1, P2, tbase, nseg, Rstar=Rstar, Mstar=Mstar, ftdur=ftdur
+        )
+    else:
+        assert False, "partition must be log or cost"
+
     dL = []
     for i in range(nseg):
         P1 = PlimArr[i]
@@ -805,77 +1809,638 @@ def periodogram_parameters(P1, P2, tbase, nseg, Rstar=1.0, Mstar=1.0,
 
     return dL
 
+def _equal_cost_limits(P1, P2, tbase, nseg, nfine=50, niter=10, **kwargs):
+    """Segment boundaries that split the search into equal cost pieces
+
+    Tabulate the cost on a fine logrithmic grid of `nfine` sub-segments
+    per segment, then interpolate the cumulative cost to find the
+    boundaries. A segment searches the durations of its longest period
+    at every period, so it costs more than its sub-segments. The
+    boundaries are then refined `niter` times with the cost of the
+    actual segments, keeping the partition with the cheapest most
+    expensive segment.
+    """
+    ncad = int(tbase / config.lc)
+    PlimFine = np.logspace( np.log10(P1) , np.log10(P2), nseg*nfine + 1 )
+    PlimFine[0] = P1
+    PlimFine[-1] = P2
+    cost = _segments_cost(PlimFine, tbase, ncad, **kwargs)
+    PlimArr = _interp_limits(PlimFine, cost, nseg)
+
+    best = PlimArr
+    best_cost = _segments_cost(PlimArr, tbase, ncad, **kwargs)
+    for i in range(niter):
+        cost = _segments_cost(PlimArr, tbase, ncad, **kwargs)
+        if cost.max() < best_cost.max():
+            best, best_cost = PlimArr, cost
+        PlimArr = _interp_limits(PlimArr, cost, nseg)
+
+    return best
+
+def _segments_cost(PlimArr, tbase, ncad, **kwargs):
+    """Total segment_cost of the segments between PlimArr"""
+    cost = []
+    for i in range(len(PlimArr) - 1):
+        d = _periodogram_parameters_segment(
+            PlimArr[i], PlimArr[i+1], tbase, **kwargs
+            )
+        cost.append( np.sum(segment_cost(d, ncad)) )
+    return np.array(cost)
+
+def _interp_limits(PlimArr, cost, nseg):
+    """nseg + 1 limits at equal steps of the cumulative cost
+
+    The cost is taken to grow linearly in log period within each of
+    the segments between PlimArr.
+    """
+    cost = np.cumsum(np.hstack([0, cost]))
+    cost = 1.0 * cost / cost[-1]
+    log10PlimArr = np.interp(
+        np.linspace(0, 1, nseg+1), cost, np.log10(PlimArr)
+    )
+    PlimNew = 10**log10PlimArr
+    PlimNew[0] = PlimArr[0]
+    PlimNew[-1] = PlimArr[-1]
+    return PlimNew
+
 def cumsum_top(data,mask,k):
     """
 
     Take a data and mask array with shape = (m,n)
 
-    For each column of data, sort the values (ignoring values that are
-    masked out). Then compute the sum along columns of the m-k
-    smallest values, then the m-k+1 smallest values until all m rows
-    are summed.
+    For each column of data, find the k largest values (ignoring
+    values that are masked out). Then compute the sum along columns of
+    the m-k smallest values, then the m-k+1 smallest values until all
+    m rows are summed.
+
+    The work is done by fold.cumsum_top, which makes a single pass
+    through the array keeping the top k values of each column rather
+    than sorting the columns. pgram_max does not call this function;
+    fold.pgram_max_block does the same top-k pass inline for k = 2.
 
     Parameters 
     ----------
     data : ndim = 2,
-    mask : True if entry is included, False if not
+    mask : True if entry is masked out, False if not
+    k : number of top values to clip
+
+    Returns
+    -------
+    datasum : shape = (k+1, n). datasum[-1] is the sum of each column, 
+        datasum[-2] the sum having removed the largest value, etc.
+    datacnt : number of non-masked values entering datasum
     """
-    
+    data = np.asarray(data, dtype=float)
+    mask = np.asarray(mask, dtype=bool).view(np.uint8)
+    datasum,datacnt = fold.cumsum_top(data,mask,k)
+    return datasum,datacnt
 
-    # masked values are filled with -infs (so they don't enter into the sort)
-    nrow,ncol = data.shape
-    nrowout = k + 1
+def test_cumsum_top():
+    """fold.cumsum_top matches sorting each column
 
+    Covers ties, columns with some values masked, columns with fewer
+    than k + 1 values left, and a column that is all masked.
+    """
+    nrow,ncol = 4,10
+    arr = np.ones((nrow,ncol))
+    arr[0,2] = np.nan
+    arr[-1,-3:] = np.nan
+    arr[:,3] = 2
+    arr[1,5] = 8
+    arr[2,5] = 10
+    arr[:3,6] = np.nan
+    arr[:,7] = np.nan
+
+    np.random.seed(0)
+    rand = np.random.randn(50, 40)
+    rand[np.random.rand(50, 40) < 0.3] = np.nan
+    rand[:, 0] = np.nan
+    rand[:-2, 1] = np.nan
+
+    for data in [arr, rand]:
+        mask = np.isnan(data)
+        for k in [1, 2, 3]:
+            datasum, datacnt = cumsum_top(data, mask, k)
+            refsum, refcnt = _cumsum_top_sort(data, mask, k)
+            assert datasum.shape==(k + 1, data.shape[1])
+            assert np.array_equal(datacnt, refcnt), "k={}".format(k)
+            assert np.allclose(datasum, refsum, rtol=1e-12, atol=1e-12), \
+                "k={}".format(k)
+
+def _cumsum_top_sort(data,mask,k):
+    """cumsum_top by sorting each column (reference for the tests)"""
+    nrowout = k + 1
     datainf = data.copy() 
     datazero = data.copy()
-
     datainf[mask] = -np.inf 
     datazero[mask] = 0.0
 
     icol = np.arange(data.shape[1])
     srow = np.argsort(datainf,axis=0) # Indecies of sorted rows
-    
     datazero = datazero[srow,icol]
-    mask = mask[srow,icol]
-    cnt = (~mask).astype(int) # Counter. 1 if it's a valid point
+    cnt = (~mask[srow,icol]).astype(int)
 
-    # Substitue the sum of all the higher rows in to the nrowout row
-    # of output arrays
     datazero[-nrowout,:] = np.sum(datazero[:-k],axis=0)
     cnt[-nrowout,:] = np.sum(cnt[:-k],axis=0)
-    
     datasum = np.cumsum(datazero[-nrowout:],axis=0)
-    # Count number of masked elements
     datacnt = np.cumsum(cnt[-nrowout:],axis=0) 
     return datasum,datacnt
 
-def test_cumsum_top():
-    np.set_printoptions(precision=1)
-    nrow,ncol = 4,10
-    
-    arr = np.ones((nrow,ncol))
-    arr[0,2] = np.nan
-    arr[-1,-3:] = np.nan
-    arr[:,3] = 2
-    arr[1,5] = 8
-    arr[2,5] = 10
+def _test_lightcurve(ncad=1000, P=123.4, seed=0):
+    """White noise with box transits and a masked gap (for the tests)"""
+    np.random.seed(seed)
+    f = np.random.randn(ncad)
+    f[np.mod(np.arange(ncad) - 40, P) < 5] -= 3.0
+    mask = np.zeros(ncad, dtype=bool)
+    mask[300:330] = True
+    mask[np.random.rand(ncad) < 0.02] = True
+    return ma.masked_array(f, mask, fill_value=0)
+
+def test_pgram_max_block():
+    """fold.pgram_max_block matches the per-period loop it replaced
+
+    The reference wraps the single event statistic into a 2-D array
+    for every trial period and clips the top two values by sorting
+    the columns. Sums are taken in a different order, so s2n and mean
+    agree to round-off, the chosen columns exactly.
+    """
+    fm = _test_lightcurve()
+    dM = mtd(fm, 5)
+    noise = ma.median(ma.abs(dM)) * 1.5
+    data = np.ascontiguousarray(dM.data, dtype=float)
+    mask = ma.getmaskarray(dM)
+    PcadG = np.hstack([np.arange(P, P + 1, P / fm.size) for P in [97, 123]])
+
+    cols, ncols = fold.fold_plan(PcadG, fm.size)
+    work = np.empty((int(PcadG.max()) + 1, 3))
+    iwork = np.empty((int(PcadG.max()) + 1, 2), dtype=np.int64)
+    mean, s2n, c, col = fold.pgram_max_block(
+        data, mask.view(np.uint8), PcadG, noise, cols, ncols, work, iwork
+    )
 
-    print "Input array"
-    print arr 
-
-    mask = np.isnan(arr)
-    k = 2
-    print "cumsum arrays"
-    datasum,datacnt  = cumsum_top(arr,mask,k)
-    print datasum.astype(int)
-    print datacnt.astype(int)
-    print "Mean value"
-    s =  str(datasum.astype(float)/(datacnt.astype(float)))
-    sL = s.split('\n')
-    sL[0] += ' <- Consistent depth'
-    sL[2] += ' <- 2 outliers drive mean'
-    print "\n".join(sL)
-    
+    icad = np.arange(fm.size)
+    for i, Pcad in enumerate(PcadG):
+        row, icol = wrap_icad(icad, Pcad)
+        d = np.zeros((row.max() + 1, icol.max() + 1))
+        m = np.ones(d.shape, dtype=bool)
+        d[row, icol] = data
+        m[row, icol] = mask
+        datasum, datacnt = _cumsum_top_sort(d, m, 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rmean = datasum[-1] / datacnt[-1]
+            rs2n = datasum[-1] / np.sqrt(datacnt[-1]) / noise
+            b = (
+                (datasum[-2] / datacnt[-2] > 0.5 * rmean) & 
+                (datasum[-3] / datacnt[-3] > 0.5 * rmean) & 
+                (datacnt[-1] >= 3)
+            )
+        if not np.any(b):
+            assert col[i]==-1
+            continue
+        rcol = np.flatnonzero(b)[np.argmax(rs2n[b])]
+        assert col[i]==rcol, "Pcad={}: col {} != {}".format(Pcad,col[i],rcol)
+        assert c[i]==datacnt[-1, rcol]
+        assert np.allclose(mean[i], rmean[rcol], rtol=1e-12, atol=0)
+        assert np.allclose(s2n[i], rs2n[rcol], rtol=1e-12, atol=0)
+
+def test_FoldPlanCache():
+    """Cached fold plans are the ones fold.fold_plan builds
+
+    Walks the cache through hits and least recently used evictions,
+    then checks that pgram_max gives the same periodogram with a fresh
+    cache, a warm cache, and a cache too small to hold the search.
+    """
+    ncad = 1000
+    PcadGs = [np.arange(P, P + 1, P / ncad) for P in [20., 30., 40.]]
+    fresh = lambda PcadG : fold.fold_plan(PcadG, ncad)
+    nbytes = [sum([x.nbytes for x in fresh(P)]) for P in PcadGs]
+    cache = FoldPlanCache(ncad, max_bytes=nbytes[0] + nbytes[1])
+    for i in [0, 0, 1, 2, 0]:
+        cols, ncols = cache.get(PcadGs[i])
+        ref_cols, ref_ncols = fresh(PcadGs[i])
+        assert np.array_equal(cols, ref_cols)
+        assert np.array_equal(ncols, ref_ncols)
+        assert cache.nbytes <= cache.max_bytes
+
+    # Plan 0 is evicted by plan 2, and plan 1 by plan 0 again
+    assert (cache.hits, cache.misses)==(1, 4)
+    assert cache.nbytes==nbytes[2] + nbytes[0]
+
+    t, fm, intransit = _test_transit(ncad=2000)
+    tbase = np.ptp(t)
+    par = periodogram_parameters(2, 4, tbase, nseg=1)[0]
+    ref = pd.DataFrame(pgram_max(t, fm, par))
+    cache = FoldPlanCache(fm.size)
+    small = FoldPlanCache(fm.size, max_bytes=3 * 4 * fm.size)
+    for plan_cache in [cache, cache, small]:
+        pgram = pd.DataFrame(pgram_max(t, fm, par, plan_cache=plan_cache))
+        assert pgram.equals(ref)
+    assert cache.hits==cache.misses
+
+def test_Workspace():
+    """Buffers are only reallocated when a request outgrows them"""
+    ws = Workspace()
+    a = ws.get('a', (10, 3), fill=1.0)
+    assert a.shape==(10, 3) and np.all(a==1)
+    assert ws.stats()==dict(nalloc=1, nbytes_alloc=240, nbytes=240)
+
+    # Smaller and equal requests are views of the same buffer
+    for shape in [20, (5, 6), 30]:
+        b = ws.get('a', shape)
+        assert np.may_share_memory(a, b)
+    assert ws.nalloc==1
+
+    # Growing, or changing dtype, replaces the buffer
+    ws.get('a', 31)
+    ws.get('a', 31, dtype=np.int32)
+    ws.get('b', (2, 3), dtype=[('s2n',float), ('c',float)])
+    assert ws.stats()==dict(
+        nalloc=4, nbytes_alloc=240 + 248 + 124 + 96, nbytes=124 + 96
+    )
+
+    # Each thread has its own buffers
+    t = threading.Thread(target=ws.get, args=('a', 10))
+    t.start()
+    t.join()
+    assert ws.nalloc==5 and ws.get('a', 31, dtype=np.int32).size==31
+    assert ws.nalloc==5
+
+    ws.reset_stats()
+    assert ws.stats()==dict(nalloc=0, nbytes_alloc=0, nbytes=124 + 96 + 80)
+
+def _mtd_reference(fm, twd):
+    """mtd as it was before the methods were added (for the tests)"""
+    fm = fm.copy()
+    fm.fill_value = 0
+    w = (~fm.mask).astype(int)
+    f = fm.filled()
+    pad = np.zeros(twd)
+    f = np.hstack([pad,f,pad])
+    w = np.hstack([pad,w,pad])
+    kern = np.ones(twd,float)
+    ws = np.convolve(w*f,kern,mode='same')
+    c = np.convolve(w,kern,mode='same')
+    bc, tc, ac = c[:-2*twd], c[twd:-twd], c[2*twd:]
+    bws, tws, aws = ws[:-2*twd], ws[twd:-twd], ws[2*twd:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dM = 0.5*(bws/bc + aws/ac) - tws/tc
+    dM = ma.masked_invalid(dM)
+    dM.fill_value = 0
+    gap = (bc < twd/2) | (tc < twd/2) | (ac < twd/2)
+    dM.mask = dM.mask | gap
+    return dM
+
+def test_mtd():
+    """Every mtd method, and mtd_batch, give the original mtd
+
+    Durations are odd and even and on both sides of mtd_direct_max.
+    The masked gap and the ends of the light curve check that boxes
+    are clipped the same way. Sums are taken in a different order, so
+    the depths agree to round-off and the masks exactly.
+    """
+    fm = _test_lightcurve()
+    twdG = [1, 2, 5, 8, mtd_direct_max, mtd_direct_max + 1, 20, 35]
+    ref = [_mtd_reference(fm, twd) for twd in twdG]
+    res = dict(batch=mtd_batch(fm, twdG))
+    for method in ['auto', 'direct', 'cumsum', 'fft']:
+        res[method] = [mtd(fm, twd, method=method) for twd in twdG]
+
+    for method, dMG in res.items():
+        for twd, dM, dM_ref in zip(twdG, dMG, ref):
+            msg = "method={} twd={}".format(method, twd)
+            assert np.array_equal(dM.mask, dM_ref.mask), msg
+            assert np.allclose(
+                dM.filled(), dM_ref.filled(), rtol=1e-9, atol=1e-12
+            ), msg
+
+def test_MTDCache():
+    """Cached, spilled, and reloaded mtd are the ones mtd computes
+
+    The memory budget holds a single entry, so the other durations
+    are spilled to a temporary h5 file and read back. Durations given
+    as floats share the entries of the equal ints.
+    """
+    import tempfile
+    import shutil
+    import h5py
+    fm = _test_lightcurve()
+    fingerprint = lightcurve_fingerprint(fm)
+    twdG = [3, 5, 8]
+    ref = dict((twd, mtd(fm, twd)) for twd in twdG)
+    tempdir = tempfile.mkdtemp()
+    try:
+        spill_file = os.path.join(tempdir, 'mtd.h5')
+        cache = MTDCache(max_bytes=_mtd_nbytes(ref[3]), spill_file=spill_file)
+        dMG = cache.get_batch(fm, twdG)
+        twdG += [8, 5.0, 3, 5, 8.0]
+        dMG += [cache.get(fm, twd) for twd in [8, 5.0, 3]]
+        dMG += cache.get_batch(fm, [5, 8.0])
+        for twd, dM in zip(twdG, dMG):
+            assert np.array_equal(dM.mask, ref[twd].mask)
+            assert np.allclose(dM.filled(), ref[twd].filled(), atol=1e-12)
+        assert len(cache._entries)==1 and cache.nbytes <= cache.max_bytes
+        assert (cache.hits, cache.misses, cache.spill_hits)==(1, 3, 4)
+        with h5py.File(spill_file, 'r') as h5:
+            assert sorted(h5[fingerprint].keys())==['3', '5', '8']
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_bls_block():
+    """fold.bls_block matches fold_col and bls for each period
+
+    bls accumulates in single precision, so the statistics agree to
+    ~1e-6.
+    """
+    fm = _test_lightcurve()
+    data = np.ascontiguousarray(fm.data, dtype=float)
+    mask = ma.getmaskarray(fm)
+    PcadG = np.hstack([np.arange(P, P + 1, P / fm.size) for P in [97, 123]])
+    twd1, twd2 = 3, 8
+
+    s2n, twd, col, mean, noise = fold.bls_block(
+        data, mask.view(np.uint8), PcadG, twd1, twd2
+    )
+
+    icad = np.arange(fm.size)
+    for i, Pcad in enumerate(PcadG):
+        row, icol = wrap_icad(icad, Pcad)
+        ccol, scol, sscol = fold.fold_col(data, mask.astype(np.int64), icol)
+        ref = fold.bls(ccol, scol, sscol, icol.max() + 1, twd1, twd2)
+        assert np.allclose([s2n[i], mean[i], noise[i]], 
+                           [ref[0], ref[3], ref[4]], rtol=1e-5)
+        assert (twd[i], col[i])==(ref[1], ref[2]), \
+            "Pcad={}: box {} != {}".format(Pcad, (twd[i], col[i]), ref[1:3])
+
+def test_foreman_mackey():
+    """foreman_mackey matches the per-period loop it replaced
+
+    For every trial period, the reference folds the single transit
+    fits of each duration, combines the good transits in each column,
+    and keeps the first column with the highest phic_same among those
+    that pass the cuts, scanning durations and then columns. Every
+    period passes on the test light curve. With the flux made
+    positive every depth is negative, so none pass.
+    """
+    fm = _test_lightcurve()
+    t = np.arange(fm.size) * config.lc
+    par = dict(Pcad1=122, Pcad2=125, twdG=[3, 5, 8])
+    PcadG = np.hstack(
+        [np.arange(P, P + 1, 1.0 * P / fm.size) for P in range(122, 125)]
+    )
+    alpha = 1200.0
+    icad = np.arange(fm.size)
+    for fm, passes in [(fm, True), (ma.abs(fm), False)]:
+        pgram = foreman_mackey(t, fm, par)
+        res_1d = foreman_mackey_1d_batch(fm, par['twdG'])
+        assert len(pgram)==len(PcadG)
+        for i, Pcad in enumerate(PcadG):
+            row, col = wrap_icad(icad, Pcad)
+            best = None
+            for itwd, twd in enumerate(par['twdG']):
+                res = res_1d[itwd]
+                for icol in range(col.max() + 1):
+                    b = (col==icol) & (res['good_trans']==1)
+                    nind = b.sum()
+                    if nind==0:
+                        continue
+                    w = res['depth_ivar_1d'][b]
+                    d = res['depth_1d'][b]
+                    sdll = np.sum(res['dll_1d'][b])
+                    depth_2d = np.sum(w * d) / np.sum(w)
+                    same = (sdll - 0.5 * np.sum(w * (d - depth_2d)**2) 
+                            - 0.5 * alpha)
+                    variable = sdll - 0.5 * alpha * nind
+                    if depth_2d > 0 and same > variable and nind >= 2 and \
+                       (best is None or same > best['phic_same']):
+                        best = dict(
+                            phic_same=same, phic_variable=variable, 
+                            depth_2d=depth_2d, depth_ivar_2d=np.sum(w), 
+                            nind=nind, col=icol, twd=twd, Pcad=Pcad
+                        )
+
+            assert (best is not None)==passes, "Pcad={}".format(Pcad)
+            if best is None:
+                assert pgram[i]['Pcad']==0, "Pcad={} passes".format(Pcad)
+                continue
+            for key in 'nind col twd Pcad'.split():
+                assert pgram[i][key]==best[key], \
+                    "Pcad={} {}".format(Pcad, key)
+            keys = 'phic_same phic_variable depth_2d depth_ivar_2d'.split()
+            for key in keys:
+                assert np.allclose(pgram[i][key], best[key], rtol=1e-9), \
+                    "Pcad={} {}".format(Pcad, key)
+
+def test_FFAStream():
+    """FFAStream matches FFA applied to the wrapped array
+
+    Integer valued data, so the float32 sums are exact. When the number
+    of rows M = ceil(N / P0) is a power of 2 the result must be
+    identical to FFA on the XWrap2 arrays.
+
+    Other M have no FFA to compare with, so the path of each output
+    row is probed with unit impulses. Row i must add every row r of
+    the wrap once, shifted by s(r) columns, where s goes from 0 to i,
+    never decreases, and is within half a column per level of the
+    recursion of the straight line r * i / (M - 1). Folding with those
+    shifts must reproduce sumF and countF.
+    """
+    np.random.seed(0)
+    cases = [
+        (37, 37 * 15 + 5), (50, 50 * 31 + 1), (16, 16 * 7 + 3), # M = 2**k
+        (11, 11 * 5 + 2), (13, 13 * 12), (7, 7 * 23 + 1), (64, 64 * 100 + 1)
+    ]
+    for P0, n in cases:
+        x = np.random.randint(-50, 50, n).astype(np.float32)
+        w = (np.random.rand(n) > 0.1).astype(np.float32)
+        sumF, countF = FFA.FFAStream(x, w, P0)
+        M = sumF.shape[0]
+        assert M==int(np.ceil(1.0 * n / P0))
+
+        xw = np.ascontiguousarray(x * w)
+        if M & (M - 1)==0:
+            ref_sum = FFA.FFA(ma.filled(FFA.XWrap2(xw, P0, pow2=True), 0))
+            ref_count = FFA.FFA(ma.filled(FFA.XWrap2(w, P0, pow2=True), 0))
+            assert np.array_equal(sumF, ref_sum), "P0={}".format(P0)
+            assert np.array_equal(countF, ref_count), "P0={}".format(P0)
+
+        shift = _ffa_stream_shift(P0, n)
+        line = np.outer(np.arange(M), np.arange(M)) / max(M - 1.0, 1.0)
+        assert np.all(shift[:,0]==0) and np.all(shift[:,-1]==np.arange(M))
+        assert np.all(np.diff(shift, axis=1) >= 0)
+        assert np.abs(shift - line).max() <= 0.5 * np.ceil(np.log2(M))
+
+        pad = np.zeros(M * P0 - n, dtype=np.float32)
+        xwrap = np.hstack([xw, pad]).reshape(M, P0)
+        wwrap = np.hstack([w, pad]).reshape(M, P0)
+        icol = np.arange(P0)
+        for i in range(M):
+            cols = np.mod(icol[np.newaxis,:] + shift[i][:,np.newaxis], P0)
+            rows = np.arange(M)[:,np.newaxis]
+            assert np.array_equal(sumF[i], xwrap[rows, cols].sum(axis=0))
+            assert np.array_equal(countF[i], wwrap[rows, cols].sum(axis=0))
+
+def _ffa_stream_shift(P0, n):
+    """Shift (columns) of every wrapped row in every FFAStream row
+
+    Returns shift[i, r], unwrapped to the multiple of P0 closest to
+    the straight line r * i / (M - 1).
+    """
+    M = int(np.ceil(1.0 * n / P0))
+    line = np.outer(np.arange(M), np.arange(M)) / max(M - 1.0, 1.0)
+    w = np.ones(n, dtype=np.float32)
+    x = np.zeros(n, dtype=np.float32)
+    shift = np.zeros((M, M))
+    for r in range(M):
+        x[:] = 0
+        x[r * P0] = 1
+        sumF, countF = FFA.FFAStream(x, w, P0)
+        shift[:,r] = np.mod(-np.argmax(sumF, axis=1), P0)
+    return (shift + P0 * np.round((line - shift) / P0)).astype(int)
+
+def test_foreman_mackey_1d_batch():
+    """Prefix sum box fits match the per-cadence loop they replaced"""
+    fm = _test_lightcurve(ncad=500)
+    twdG = [1, 4, 7]
+    res = foreman_mackey_1d_batch(fm, twdG)
+
+    fmfilled = fm.filled()
+    ivar = 1.0 / np.median(np.diff(fm.compressed()) ** 2)
+    for itwd, twd in enumerate(twdG):
+        for cad1 in range(fm.size):
+            data = fmfilled[cad1:cad1 + twd]
+            s = np.sum(data)
+            c = np.sum(~fm.mask[cad1:cad1 + twd])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                m = s / c
+            dll = -0.5 * ivar * (np.sum((data - m)**2) - np.sum(data**2))
+            r = res[itwd, cad1]
+            assert r['good_trans']==int(c > twd / 2.0)
+            assert r['depth_ivar_1d']==ivar * c
+            assert np.allclose(
+                [r['depth_1d'], r['dll_1d']], [-m, dll], rtol=1e-9, 
+                atol=1e-9, equal_nan=True
+            ), "twd={} cad={}".format(twd, cad1)
+
+def _test_transit(ncad=4000, P=12.34, t0=3.21, tdur=0.25, depth=5e-4):
+    """Box shaped transit in white noise with a masked gap (for the tests)
+
+    Returns:
+        t, fm : evenly spaced times and the masked flux
+        intransit : True for the cadences in transit
+    """
+    np.random.seed(0)
+    t = np.arange(ncad) * config.lc
+    f = np.random.randn(ncad) * 1e-4
+    intransit = np.abs(np.mod(t - t0 + 0.5 * P, P) - 0.5 * P) < 0.5 * tdur
+    f[intransit] -= depth
+    mask = np.zeros(ncad, dtype=bool)
+    mask[1000:1100] = True
+    fm = ma.masked_array(f, mask, fill_value=0)
+    return t, fm, intransit
+
+def test_periodogram_parameters_cost():
+    """partition='cost' covers [P1, P2] with segments of similar cost"""
+    for P1, P2, tbase, nseg in [(0.5, 40, 80, 6), (1, 20, 80, 4)]:
+        ncad = int(tbase / config.lc)
+        cost = {}
+        for partition in ['log','cost']:
+            param_list = periodogram_parameters(
+                P1, P2, tbase, nseg, partition=partition
+            )
+            Plim = [par['P1'] for par in param_list] + [param_list[-1]['P2']]
+            assert np.allclose([Plim[0], Plim[-1]], [P1, P2], rtol=1e-12)
+            assert np.all(np.diff(Plim) > 0), "limits must increase"
+            if partition=='cost':
+                assert (Plim[0], Plim[-1])==(P1, P2)
+            cost[partition] = np.array(
+                [np.sum(segment_cost(par, ncad)) for par in param_list]
+            )
+
+        spread = cost['cost'].max() / cost['cost'].mean()
+        assert spread < 1.1, "segment costs {}".format(cost['cost'])
+        assert cost['cost'].max() < cost['log'].max()
+
+def test_periodogram_backends():
+    """The thread and process backends give the serial periodogram
+
+    The segments are split into more work units than there are
+    segments, so this also checks that the blocks are put back in
+    order.
+    """
+    t, fm, intransit = _test_transit()
+    tbase = np.ptp(t)
+    pgram_params = periodogram_parameters(8, 0.49 * tbase, tbase, nseg=3)
+    grid = Grid(t, fm)
+    serial = grid.periodogram(pgram_params, mode='max')
+    for backend in ['thread', 'process']:
+        pgram = grid.periodogram(
+            pgram_params, mode='max', backend=backend, nproc=2, nunits=7
+        )
+        assert pgram.equals(serial), "{} != serial".format(backend)
+
+def test_periodogram_adaptive():
+    """Adaptive and exhaustive searches find the same peak
+
+    Injects a box shaped transit into white noise and checks that
+    periodogram_adaptive recovers the same P, t0, and s2n as the full
+    resolution periodogram.
+    """
+    P = 12.34
+    t, fm, intransit = _test_transit(P=P)
+    tbase = np.ptp(t)
+    pgram_params = periodogram_parameters(8, 0.49 * tbase, tbase, nseg=3)
+    grid = Grid(t, fm)
+    full = grid.periodogram(pgram_params, mode='max')
+    adaptive = grid.periodogram(pgram_params, mode='max', adaptive=True)
+
+    # Neighboring periods can tie for the peak, so compare the
+    # adaptive peak with the same period in the exhaustive search
+    peak = adaptive.sort_values('s2n').iloc[-1]
+    match = full[np.isclose(full['P'], peak['P'], rtol=1e-12)].iloc[0]
+    print "exhaustive: P={P:.4f} t0={t0:.4f} s2n={s2n:.2f}".format(**match)
+    print "adaptive:   P={P:.4f} t0={t0:.4f} s2n={s2n:.2f}".format(**peak)
+    assert peak['refined']
+    assert np.allclose(full['s2n'].max(), peak['s2n'])
+    assert np.allclose(match['s2n'], peak['s2n'])
+    assert np.allclose(match['t0'], peak['t0'])
+    assert np.abs(peak['P'] - P) < 0.01
+
+def test_periodogram_update():
+    """periodogram_update gives the periodogram of the masked flux
+
+    Masking one transit with ncand=8 leaves the candidates of almost
+    every period valid, so only their changed phases are folded again.
+    Masking every transit with ncand=1 pushes most periods below their
+    candidate floor, so they are folded again in full. Either way the
+    result is the periodogram of the masked flux, up to round-off in
+    the column sums.
+    """
+    t, fm, intransit = _test_transit(ncad=2000, P=3.1)
+    tbase = np.ptp(t)
+    pgram_params = periodogram_parameters(2, 4, tbase, nseg=1)
+    for ncand, ntransit in [(8, 1), (1, None)]:
+        grid = Grid(t, fm)
+        grid.periodogram(pgram_params, mode='max', ncand=ncand)
+        fm_masked = fm.copy()
+        icad = np.flatnonzero(intransit)
+        if ntransit is not None:
+            icad = icad[icad < icad[0] + int(1 / config.lc)]
+        fm_masked[icad] = ma.masked
+        pgram = grid.periodogram_update(fm_masked)
+        ref = Grid(t, fm_masked).periodogram(pgram_params, mode='max')
+
+        state = grid._pgram_states[0]
+        ntrial = state['PcadG'].size * len(pgram_params[0]['twdG'])
+        if ntransit is None:
+            assert state['nfull'] > 0.5 * ntrial
+        else:
+            assert state['nfull'] < 0.01 * ntrial
+        assert list(pgram.columns)==list(ref.columns)
+        for k in ref.columns:
+            if k in ['s2n', 'mean']:
+                assert np.allclose(pgram[k], ref[k], rtol=1e-12, atol=0)
+            else:
+                assert np.array_equal(pgram[k], ref[k]), k
 
 def wrap_icad(icad,Pcad):
     """
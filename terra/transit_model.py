@@ -1,13 +1,12 @@
+import copy
 import sys
 
 import numpy as np
+from numpy import ma
 from scipy import optimize
 import pandas as pd
-from matplotlib.pylab import *
-from emcee import EnsembleSampler
 
 import keptoy
-from plotting.kplot import *
 from utils import h5plus 
 
 class TransitModel(h5plus.iohelper):
@@ -164,6 +163,7 @@ class TransitModel(h5plus.iohelper):
         chain : nsamp x 3 array of the parameters tried in the MCMC chain.
         fits  : Light curve fits selected randomly from the MCMC chain.
         """
+        from emcee import EnsembleSampler
         
         # MCMC parameters
         nwalkers = 10; ndims = 3
@@ -403,6 +403,8 @@ def from_dv(dv,bin_period=50):
 
 
 def plot_transit_model(tm):
+    from matplotlib.pylab import gcf, legend
+    from matplotlib.gridspec import GridSpec
     import pdb;pdb.set_trace()
     gs = GridSpec(4,1)        
     fig = gcf()
@@ -418,8 +420,10 @@ def plot_transit_model(tm):
     legend()
 
 def plot_trans(tm):
+    from matplotlib.pylab import plot
     plot(tm.t,tm.f,'.',label='PF LC')
     plot(tm.t,tm.fit,lw=2,alpha=2,label='Fit')
 
 def plot_res(tm):
+    from matplotlib.pylab import plot
     plot(tm.t,tm.f-tm.fit,lw=1,alpha=1,label='Residuals')        
@@ -3,27 +3,24 @@ Transit Validation
 
 After the brute force period search yeilds candidate periods,
 functions in this module will check for transit-like signature.
+
+batman, lmfit, scipy.ndimage, scipy.spatial, and h5plus are imported
+by the functions that use them, so that importing this module is cheap.
 """
 
 
+import collections
+
 import numpy as np
 from numpy import ma
-from scipy import ndimage as nd
-from scipy.spatial import cKDTree
-from matplotlib import mlab
-import h5py
 
 import pandas as pd
 
-from utils import h5plus
 import FFA
 
 import keptoy
 import tfind
-import keplerio
 import config
-import batman
-from lmfit import Parameters, minimize, fit_report, minimizer
 import utils.hdfstore
 
 def phasefold(t, P, t0, starting_phase=-0.5):
@@ -131,7 +128,7 @@ class DataValidation(utils.hdfstore.HDFStore):
     def _attach_convenience(self):
         self.t  = np.array(self.lc['t'])
         self.fm = ma.masked_array(self.lc['f'],self.lc['fmask'])
-        self.dM = tfind.mtd(self.fm, self.tdurcad)
+        self.dM = tfind.mtd_cache.get(self.fm, self.tdurcad)
 
     def at_SES(self):
         """
@@ -314,6 +311,7 @@ class DataValidation(utils.hdfstore.HDFStore):
 
     def at_med_filt(self):
         """Add median detrended lc"""
+        from scipy import ndimage as nd
         fmed = self.fm - nd.median_filter(self.fm, size=self.header['tdurcad']*3)
 
         # Shift t-series so first transit is at t = 0 
@@ -357,6 +355,7 @@ class DataValidation(utils.hdfstore.HDFStore):
 
 
 def read_hdf(h5file,group):
+    from utils import h5plus
     tm = h5plus.read_iohelper(h5file,group)
     tm.__class__ = DV
 
@@ -389,6 +388,7 @@ def scar(res):
     x /= max(x)
     y = (res['t0cad']/res['Pcad'])[bcut]
 
+    from scipy.spatial import cKDTree
     D = np.vstack([x,y]).T
     tree = cKDTree(D)
     d,i= tree.query(D,k=2)
@@ -455,29 +455,45 @@ def label_transit(t, P, t0, tdur, cpad=0.5, cfrac=3):
 
     labels  = np.zeros(t.size, dtype=zip( names, [int] * len(names) ) )
     labels['transit_id'] -= 1
-    
-    transit_id   = 0 # number of transit, starting at 0.
-    tmdTrans = 0 # time of iTrans mid transit time.  
-    while tmdTrans < t[-1]:
+
+    # Transits are at k * P for k = 0 .. kmax, i.e. while k * P < t[-1]
+    kmax = int(np.ceil(t[-1] / P))
+    while kmax >= 0 and kmax * P >= t[-1]:
+        kmax -= 1
+    if kmax < 0:
+        return labels
+
+    # Half width of the labeled region in units of tdur. Only transits
+    # within it of a point affect its labels, which is a handful of
+    # candidates per point, even if the regions of neighboring
+    # transits overlap.
+    width = 0.5 + cpad + cfrac
+    kfirst = np.floor((t - width * tdur) / P).astype(int)
+    ncand = int(np.ceil(2 * width * tdur / P)) + 2
+
+    # Visit candidates in increasing k, so that later transits
+    # overwrite transit_id, as they would in a loop over transits
+    for i in range(ncand):
+        k = kfirst + i
+        valid = (k >= 0) & (k <= kmax)
+
         # Time since mid transit in units of tdur
-        dt = (t - tmdTrans) / tdur
-        
+        dt = (t - k * P) / tdur
+
         # In transit points
-        labels['transit'][ np.abs(dt) < 0.5 ] = 1
+        labels['transit'][valid & (np.abs(dt) < 0.5)] = 1
 
         # Continuum points
-        continuum_before = ( -0.5 - cpad - cfrac < dt) & (dt < -0.5 - cpad) 
-        continuum_after = ( 0.5 + cpad < dt) & (dt < 0.5 + cpad + cfrac) 
+        continuum_before = valid & ( -0.5 - cpad - cfrac < dt) & (dt < -0.5 - cpad) 
+        continuum_after = valid & ( 0.5 + cpad < dt) & (dt < 0.5 + cpad + cfrac) 
 
         labels['continuum_before'][continuum_before] = 1
         labels['continuum_after'][continuum_after] = 1
         labels['continuum'][continuum_before | continuum_after] = 1
         
         # All transit points
-        labels['transit_id'][np.abs(dt) < 0.5 + cpad + cfrac] = transit_id
-
-        transit_id += 1 
-        tmdTrans = transit_id * P
+        inwidth = valid & (np.abs(dt) < width)
+        labels['transit_id'][inwidth] = k[inwidth]
 
     return labels
 
@@ -534,29 +550,38 @@ def local_detrending(lc, P, t0, tdur, poly_degree=3, min_continuum=2,
 
     lcdt = lcdt[lcdt.transit_id.isin(transit_id_good)]
 
-    def detrend(x):
-        """Function that detrends a single light section of light curve"""
-
-        t = x['t']
-        f = x['f']
-        t0 = np.mean(x['t'])
-        time_since_transit = t - t0
-
-        # select out just the continuum points
-        continuum = x['continuum']==1
-
-        pfit = np.polyfit(
-            time_since_transit[continuum], f[continuum], poly_degree
-            )
-
-        fldt = f.copy()
-        fldt -= np.polyval(pfit,time_since_transit)
-        return fldt
-
-    g = lcdt.groupby('transit_id')
-    fldt = map(detrend,[ lcdt.ix[idx] for idx in g.groups.values() ] )
-    fldt = pd.concat(fldt)
-    lcdt['f'] = fldt
+    if len(lcdt)==0:
+        return lcdt
+
+    # Fit the continuum of every transit at once. The normal equations
+    # of the continuum points are summed by transit and solved as a
+    # batch. Time is measured from the mean time of each transit, as
+    # before, and scaled to [-1, 1] to keep the equations well
+    # conditioned.
+    t = np.array(lcdt.t, dtype=float)
+    f = np.array(lcdt.f, dtype=float)
+    continuum = np.array(lcdt.continuum==1)
+    _, group = np.unique(np.array(lcdt.transit_id), return_inverse=True)
+    ngroup = group.max() + 1
+    time_since_transit = t - (np.bincount(group, t) / np.bincount(group))[group]
+    scale = np.zeros(ngroup)
+    np.maximum.at(scale, group, np.abs(time_since_transit))
+    scale[scale==0] = 1.0
+
+    V = np.vander(time_since_transit / scale[group], poly_degree + 1)
+    Vc = V[continuum]
+    gc = group[continuum]
+    npar = poly_degree + 1
+    A = np.empty((ngroup, npar, npar))
+    b = np.empty((ngroup, npar))
+    for i in range(npar):
+        b[:, i] = np.bincount(gc, Vc[:, i] * f[continuum], minlength=ngroup)
+        for j in range(i, npar):
+            A[:, i, j] = np.bincount(gc, Vc[:, i] * Vc[:, j], minlength=ngroup)
+            A[:, j, i] = A[:, i, j]
+
+    pfit = np.linalg.solve(A, b[:, :, np.newaxis])[:, :, 0]
+    lcdt['f'] = f - np.sum(V * pfit[group], axis=1)
     return lcdt
 
 
@@ -581,10 +606,18 @@ class TransitModel(object):
             batman transit model code.
         subtract_one (bool, optional): when computing the model, do we subtract
             unity from light curve.
+
+    batman.TransitModel objects are cached, keyed by the identity of
+    the time array, supersample_factor, exp_time, and limb_dark, so
+    repeated calls to `model` during a fit (same `t` array) only
+    update the transit parameters instead of rebuilding the
+    supersampled time grid. Set batman_cache_size to 0 to disable.
     """
+    batman_cache_size = 8
 
     def __init__(self, P, t0, rp, tdur, b, ecc=0.0, w=0.0, limb_dark='linear',
                  u=[0.66], subtract_one=True, batman_kw=None):
+        from lmfit import Parameters
         if batman_kw==None:
             batman_kw = {}
 
@@ -602,8 +635,36 @@ class TransitModel(object):
         self.lm_params = lm_params
         self.batman_kw = batman_kw
         self.subtract_one = subtract_one
+        self._batman_cache = collections.OrderedDict()
+
+    def __getstate__(self):
+        # batman objects are not worth copying, rebuild them on demand
+        state = self.__dict__.copy()
+        state['_batman_cache'] = collections.OrderedDict()
+        return state
+
+    def _get_batman_model(self, bm_params, t):
+        """Return a batman.TransitModel for t, reusing a cached one"""
+        import batman
+        if self.batman_cache_size==0:
+            return batman.TransitModel(bm_params, t, **self.batman_kw)
+
+        key = (
+            id(t), self.batman_kw.get('supersample_factor', 1),
+            self.batman_kw.get('exp_time', 0.0), self.limb_dark
+        )
+        # The entry holds a reference to t, so id(t) cannot be reused
+        # by another array while the entry is alive
+        entry = self._batman_cache.pop(key, None)
+        if entry is None or entry[0] is not t:
+            entry = (t, batman.TransitModel(bm_params, t, **self.batman_kw))
+        self._batman_cache[key] = entry
+        while len(self._batman_cache) > self.batman_cache_size:
+            self._batman_cache.popitem(last=False)
+        return entry[1]
 
     def model(self, lm_params, t):
+        import batman
         per = lm_params['per'].value
         t0 = lm_params['t0'].value
         rp = lm_params['rp'].value
@@ -619,7 +680,7 @@ class TransitModel(object):
         bm_params.w = self.w 
         bm_params.limb_dark = self.limb_dark
         bm_params.u = self.u 
-        m = batman.TransitModel(bm_params, t, **self.batman_kw)
+        m = self._get_batman_model(bm_params, t)
         _model = m.light_curve(bm_params) 
         if self.subtract_one:
             _model -= 1
@@ -631,6 +692,64 @@ class TransitModel(object):
         resid = (f - _model) / ferr
         return resid    
 
+    def jacobian(self, lm_params, t, f, ferr):
+        """Jacobian of `residual` with respect to the varied parameters
+
+        Forward differences, one model call per varied parameter, which
+        is cheap because the batman model is cached. Pass as Dfun to
+        lmfit's leastsq with col_deriv=False.
+
+        Returns:
+            jac (array): shape (len(t), number of varied parameters),
+                in the order of lm_params
+        """
+        params = lm_params.copy()
+        names = [key for key, par in params.items() if par.vary]
+        _model = self.model(params, t)
+        jac = np.empty((len(t), len(names)))
+        for i, key in enumerate(names):
+            par = params[key]
+            value = par.value
+            step = 1e-6 * max(abs(value), 1.0)
+            # lmfit clips values to the bounds, so step away from them
+            if value + step > par.max:
+                step = -step
+            par.value = value + step
+            jac[:, i] = -(self.model(params, t) - _model) / step / ferr
+            par.value = value
+        return jac
+
+    def to_dict(self):
+        """Lightweight, picklable description of the model
+
+        lmfit Parameters do not always survive pickling, so the
+        parameters are stored as (value, vary, min, max) tuples. Use
+        `transit_model_from_dict` to rebuild the model, e.g. in a
+        worker process.
+        """
+        params = dict(
+            [(key, (par.value, par.vary, par.min, par.max)) 
+             for key, par in self.lm_params.items()]
+        )
+        return dict(
+            params=params, ecc=self.ecc, w=self.w, limb_dark=self.limb_dark,
+            u=self.u, subtract_one=self.subtract_one, 
+            batman_kw=self.batman_kw
+        )
+
+def transit_model_from_dict(d):
+    """Rebuild a TransitModel from TransitModel.to_dict"""
+    params = d['params']
+    tm = TransitModel(
+        params['per'][0], params['t0'][0], params['rp'][0], 
+        params['tdur'][0], params['b'][0], ecc=d['ecc'], w=d['w'], 
+        limb_dark=d['limb_dark'], u=d['u'], subtract_one=d['subtract_one'],
+        batman_kw=d['batman_kw']
+    )
+    for key, (value, vary, _min, _max) in params.iteritems():
+        tm.lm_params[key].set(value=value, vary=vary, min=_min, max=_max)
+    return tm
+
 def compute_a(P, T14, rp, b):
     """ Compute scaled semi-major axis from P, T14, rp, and b """
     _a = P / np.pi / T14 * np.sqrt( (1+ rp)**2 - b )
@@ -66,7 +66,8 @@ class HDFStore(object):
         print self.tables.to_string()
         
 
-    def to_hdf(self, h5file, group):
+    def to_hdf(self, h5file, group, format='fixed', complevel=5, 
+               complib='zlib'):
         """ Write object as HDF5 file
 
         Args:
@@ -74,22 +75,90 @@ class HDFStore(object):
             group (str): base group to write to. If set to '/', an object with 
                 tableA will write to '/header', '/tableA'. If set to '/group',
                 will write to '/group/header', '/group/tableA'
+            format (Optional[str]): storage layout
+                - fixed : one DataFrame.to_hdf call per table, header and
+                  table list as pickled frames (default)
+                - table : everything is written through one open file.
+                  Tables use the columnar PyTables layout, chunked, with
+                  the shuffle filter and compression. Header values are
+                  stored as typed attributes of the group + '/header'
+                  node.
+            complevel (Optional[int]): compression level, format='table'
+            complib (Optional[str]): compression library, format='table'
         """
-        
-        self.header.to_hdf(h5file, group + '/header')
-        self.tables.to_hdf(h5file, group + '/tables')
+        if format=='fixed':
+            self.header.to_hdf(h5file, group + '/header')
+            self.tables.to_hdf(h5file, group + '/tables')
+            for table_name, row in self.tables.iterrows():
+                table = getattr(self, table_name)
+                table.to_hdf(h5file, group + '/' + table_name)
+        elif format=='table':
+            store = pd.HDFStore(h5file, complevel=complevel, complib=complib)
+            with store:
+                self._to_hdfstore(store, group.rstrip('/'))
+        else:
+            assert False, "format must be fixed or table"
+
+    def _to_hdfstore(self, store, group):
+        """Write with format='table' to an open pandas HDFStore"""
+        # Header values as attributes, descriptions as a string table
+        name = group + '/header'
+        if name in store:
+            store.remove(name)
+        where, leaf = name.rsplit('/', 1)
+        node = store._handle.create_group(
+            where or '/', leaf, createparents=True
+        )
+        for key, row in self.header.iterrows():
+            node._v_attrs[key] = row['value']
+
+        description = self.header[['description']].fillna('')
+        store.put(group + '/header_description', description, format='table')
+
+        # The shape tuples are split into columns so that the table
+        # list can use the columnar layout too
+        tables = pd.DataFrame(index=self.tables.index)
+        tables['description'] = self.tables['description'].fillna('')
+        tables['nrows'] = [shape[0] for shape in self.tables['shape']]
+        tables['ncols'] = [shape[1] for shape in self.tables['shape']]
+        store.put(group + '/tables', tables, format='table')
+
         for table_name, row in self.tables.iterrows():
             table = getattr(self, table_name)
-            table.to_hdf(h5file, group + '/' + table_name)
+            store.put(group + '/' + table_name, table, format='table')
 
     def read_hdf(self, h5file, group):
-        """ Read info from HDF file """
-        self.header = pd.read_hdf(h5file, group + '/header')
-        self.tables = pd.read_hdf(h5file, group + '/tables')
+        """ Read info from HDF file, written with either format """
+        group = group.rstrip('/')
+        with pd.HDFStore(h5file, 'r') as store:
+            node = store.get_node(group + '/header')
+            if 'pandas_type' in node._v_attrs:
+                self.header = store[group + '/header']
+                self.tables = store[group + '/tables']
+            else:
+                self._read_hdfstore(store, group, node)
 
-        for table_name, row in self.tables.iterrows():
-            table = pd.read_hdf(h5file, group + '/' + table_name)
-            setattr(self, table_name, table)
+            for table_name, row in self.tables.iterrows():
+                table = store[group + '/' + table_name]
+                setattr(self, table_name, table)
 
         for name, row in self.header.iterrows():
             setattr(self, name, row['value'])
+
+    def _read_hdfstore(self, store, group, node):
+        """Read the header and table list written with format='table'"""
+        description = store[group + '/header_description']['description']
+        value = [node._v_attrs[name] for name in description.index]
+        self.header = pd.DataFrame(
+            dict(value=value, description=description), 
+            index=description.index, columns=['value','description']
+        )
+        self.header.index.name = 'name'
+
+        tables = store[group + '/tables']
+        shape = zip(tables['nrows'], tables['ncols'])
+        self.tables = pd.DataFrame(
+            dict(shape=shape, description=tables['description']), 
+            index=tables.index, columns=['shape','description']
+        )
+        self.tables.index.name = 'name'